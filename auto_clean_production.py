@@ -50,6 +50,10 @@ async def auto_clean_production():
         await db.orders.delete_one({"_id": order["_id"]})
         deleted_orders += 1
     
+    # Plus aucune commande: l'index de déduplication ne doit plus renvoyer vers ces fichiers
+    await db.blobs.delete_many({})
+    # L'index des fichiers autorise les téléchargements: il part avec les commandes
+    await db.order_files.delete_many({})
     print(f"✅ {deleted_orders} commandes supprimées")
     print(f"✅ {deleted_files} fichiers supprimés")
     
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Script pour indexer dans order_files les fichiers des commandes existantes
+Usage: python backfill_order_files.py [--dry-run]
+
+Les fichiers envoyés depuis la création de l'index y sont déjà; le script peut
+être relancé sans créer de doublons.
+"""
+
+import asyncio
+import os
+import sys
+
+# Add the backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from pymongo import ReplaceOne
+
+from server import FileVersion, OrderFile, client, db, init_db, order_file_key, storage
+
+async def file_sizes(file_ids: set) -> dict:
+    """Original size and digest per file, from the blob index or the stored file"""
+    sizes = {}
+    async for blob in db.blobs.find({"file_id": {"$in": list(file_ids)}}, {"file_id": 1, "length": 1, "sha256": 1}):
+        sizes[blob["file_id"]] = (blob["length"], blob["sha256"])
+    for file_id in file_ids - sizes.keys():
+        try:
+            stored = await storage.open(file_id)
+            sizes[file_id] = (stored.content_length, stored.metadata.get("sha256"))
+        except FileNotFoundError:
+            sizes[file_id] = (None, None)
+    return sizes
+
+async def backfill_order_files(dry_run: bool):
+    print("🗂️  DMR DÉVELOPPEMENT - Indexation des fichiers de commandes")
+    print("=" * 50)
+    if dry_run:
+        print("🔍 Mode simulation: aucune modification")
+
+    orders = indexed = missing = 0
+    async for order in db.orders.find({"files.0": {"$exists": True}}, {"id": 1, "user_id": 1, "files": 1}):
+        orders += 1
+        sizes = await file_sizes({file_info["file_id"] for file_info in order["files"]})
+        operations = []
+        for file_info in order["files"]:
+            length, sha256 = sizes[file_info["file_id"]]
+            missing += length is None
+            order_file = OrderFile(
+                order_id=order["id"],
+                owner_id=order["user_id"],
+                length=length,
+                sha256=sha256,
+                **FileVersion(**file_info).dict()
+            ).dict()
+            # Keyed like the entry it mirrors, so reruns and concurrent uploads don't duplicate it
+            operations.append(ReplaceOne(order_file_key(order_file), order_file, upsert=True))
+        indexed += len(operations)
+        if not dry_run:
+            await db.order_files.bulk_write(operations, ordered=False)
+
+    print(f"   ✅ {indexed} fichiers {'à indexer' if dry_run else 'indexés'} pour {orders} commandes")
+    if missing:
+        print(f"   ⚠️  {missing} fichiers absents du stockage (indexés sans taille)")
+
+async def main():
+    try:
+        await init_db()
+        await backfill_order_files("--dry-run" in sys.argv)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de la vérification des tokens JWT (avec et sans cache)
+Usage: python benchmark_jwt_cache.py [nombre_de_requêtes]
+"""
+
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import timedelta
+
+# Add the backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import server
+
+async def run(iterations: int, use_cache: bool) -> float:
+    """Average microseconds per verify_token_claims call"""
+    user_id = str(uuid.uuid4())
+    token = server.create_user_token(
+        {"id": user_id, "role": "client", "token_version": 0},
+        expires_delta=timedelta(minutes=server.ACCESS_TOKEN_EXPIRE_MINUTES),
+    )
+    # Keep the version check in memory so only the decode path is measured
+    server.token_version_cache.set(user_id, 0, ttl_seconds=3600)
+    server.jwt_cache.clear()
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        if not use_cache:
+            server.jwt_cache.clear()
+        claims = await server.verify_token_claims(token)
+        assert claims is not None
+    return (time.perf_counter() - started) / iterations * 1_000_000
+
+async def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print("🔑 DMR DÉVELOPPEMENT - Benchmark vérification JWT")
+    print("=" * 50)
+    print(f"🔁 Requêtes simulées: {iterations}")
+
+    uncached = await run(iterations, use_cache=False)
+    cached = await run(iterations, use_cache=True)
+
+    print(f"   ❄️  Sans cache (jwt.decode à chaque requête): {uncached:8.2f} µs/requête")
+    print(f"   🔥 Avec cache (même token réutilisé):        {cached:8.2f} µs/requête")
+    print(f"   ✅ Gain: {uncached - cached:.2f} µs/requête (x{uncached / cached:.1f})")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Benchmarks du stockage de fichiers, à lancer contre un backend local (jamais la production)
+Usage: python benchmark_storage.py latency [--url http://localhost:8001] [--size-mb 8] [--transfers 8]
+       python benchmark_storage.py uploads --server-pid <pid uvicorn> [--size-mb 8] [--transfers 16]
+       python benchmark_storage.py serve --server-pid <pid uvicorn> [--size-mb 64] [--transfers 4] [--rounds 8]
+       python benchmark_storage.py gridfs [--sizes-mb 1,4,10] [--chunk-kb 255,1024,4096] [--concurrency 1,8] [--files 32]
+
+Pour comparer les backends, lancer "serve" une fois par valeur de FILE_STORAGE_BACKEND.
+"gridfs" parle directement à MongoDB (MONGO_URL), sans serveur, dans une base
+jetable (BENCHMARK_MONGO_DB, "dmr_storage_benchmark" par défaut) supprimée à la fin.
+
+Identifiants admin: BENCHMARK_ADMIN_EMAIL / BENCHMARK_ADMIN_PASSWORD
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class StorageBenchmark:
+    def __init__(self, base_url, email, password):
+        self.api_url = f"{base_url.rstrip('/')}/api"
+        self.service_id = None
+        response = requests.post(f"{self.api_url}/auth/login", json={"email": email, "password": password})
+        response.raise_for_status()
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def create_order(self):
+        """Create a throwaway service and order owned by the benchmark admin"""
+        if not self.service_id:
+            response = requests.post(
+                f"{self.api_url}/admin/services",
+                json={"name": "Benchmark stockage", "price": 0.0, "is_active": False},
+                headers=self.headers,
+            )
+            response.raise_for_status()
+            self.service_id = response.json()["id"]
+        response = requests.post(f"{self.api_url}/orders", json={"service_id": self.service_id}, headers=self.headers)
+        response.raise_for_status()
+        return response.json()["id"]
+
+    def upload(self, order_id, payload, filename="benchmark.bin"):
+        started = time.perf_counter()
+        response = requests.post(
+            f"{self.api_url}/admin/orders/{order_id}/upload",
+            files={"file": (filename, payload, "application/octet-stream")},
+            data={"version_type": "v1"},
+            headers=self.headers,
+        )
+        response.raise_for_status()
+        return response.json()["file_id"], time.perf_counter() - started
+
+    def download(self, order_id, file_id):
+        started = time.perf_counter()
+        received = 0
+        with requests.get(
+            f"{self.api_url}/admin/orders/{order_id}/download/{file_id}",
+            headers=self.headers,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=256 * 1024):
+                received += len(chunk)
+        return received, time.perf_counter() - started
+
+    def probe(self, stop, samples):
+        """Time a cheap endpoint until stop is set: this is what other users feel"""
+        while not stop.is_set():
+            started = time.perf_counter()
+            requests.get(f"{self.api_url}/services")
+            samples.append((time.perf_counter() - started) * 1000)
+            time.sleep(0.01)
+
+    def probe_during(self, work):
+        samples = []
+        stop = threading.Event()
+        prober = threading.Thread(target=self.probe, args=(stop, samples))
+        prober.start()
+        try:
+            result = work()
+        finally:
+            stop.set()
+            prober.join()
+        return result, samples
+
+    def cleanup(self):
+        if self.service_id:
+            requests.delete(f"{self.api_url}/admin/services/{self.service_id}", headers=self.headers)
+
+def report_latency(label, samples):
+    if not samples:
+        print(f"   {label:<28} aucune mesure")
+        return
+    print(
+        f"   {label:<28} p50 {statistics.median(samples):7.1f} ms"
+        f"   p99 {percentile(samples, 99):7.1f} ms   max {max(samples):7.1f} ms   ({len(samples)} requêtes)"
+    )
+
+def run_latency(bench, args):
+    """Latency of unrelated requests while large files are uploaded and downloaded"""
+    payload = os.urandom(int(args.size_mb * 1024 * 1024))
+    order_id = bench.create_order()
+
+    print(f"📦 {args.transfers} transferts simultanés de {args.size_mb} MB")
+
+    _, idle = bench.probe_during(lambda: time.sleep(2))
+    report_latency("Au repos", idle)
+
+    def upload_all():
+        with ThreadPoolExecutor(max_workers=args.transfers) as pool:
+            return list(pool.map(lambda _: bench.upload(order_id, payload), range(args.transfers)))
+
+    uploads, samples = bench.probe_during(upload_all)
+    report_latency("Pendant les uploads", samples)
+
+    def download_all():
+        with ThreadPoolExecutor(max_workers=args.transfers) as pool:
+            return list(pool.map(lambda upload: bench.download(order_id, upload[0]), uploads))
+
+    downloads, samples = bench.probe_during(download_all)
+    report_latency("Pendant les téléchargements", samples)
+
+    upload_mb_s = args.size_mb * len(uploads) / max(seconds for _, seconds in uploads)
+    download_mb_s = args.size_mb * len(downloads) / max(seconds for _, seconds in downloads)
+    print(f"   ⬆️  Débit upload:        {upload_mb_s:7.1f} MB/s")
+    print(f"   ⬇️  Débit téléchargement: {download_mb_s:7.1f} MB/s")
+
+def read_rss_mb(pid):
+    """Resident memory of a process in MB, from /proc (Linux only)"""
+    with open(f"/proc/{pid}/status") as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def read_cpu_seconds(pid):
+    """User + system CPU time consumed by a process so far, from /proc (Linux only)"""
+    with open(f"/proc/{pid}/stat") as stat_file:
+        # Fields after the parenthesised command name; utime and stime are the 12th and 13th
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def run_uploads(bench, args):
+    """Peak server memory while many uploads are in flight at once"""
+    if not args.server_pid:
+        raise SystemExit("❌ --server-pid est requis pour mesurer la mémoire du serveur")
+
+    payload = os.urandom(int(args.size_mb * 1024 * 1024))
+    order_id = bench.create_order()
+    baseline = read_rss_mb(args.server_pid)
+    peak = baseline
+    stop = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not stop.is_set():
+            peak = max(peak, read_rss_mb(args.server_pid))
+            time.sleep(0.005)
+
+    print(f"📦 {args.transfers} uploads simultanés de {args.size_mb} MB")
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        with ThreadPoolExecutor(max_workers=args.transfers) as pool:
+            uploads = list(pool.map(lambda _: bench.upload(order_id, payload), range(args.transfers)))
+    finally:
+        stop.set()
+        sampler.join()
+
+    slowest = max(seconds for _, seconds in uploads)
+    print(f"   🧠 RSS au repos:          {baseline:8.1f} MB")
+    print(f"   🧠 RSS max:               {peak:8.1f} MB")
+    print(f"   📈 Par upload en cours:   {(peak - baseline) / args.transfers:8.2f} MB")
+    print(f"   ⬆️  Débit agrégé:          {args.size_mb * args.transfers / slowest:8.1f} MB/s")
+
+def run_serve(bench, args):
+    """Download throughput and server CPU per GB served, for the configured storage backend"""
+    if not args.server_pid:
+        raise SystemExit("❌ --server-pid est requis pour mesurer le CPU du serveur")
+
+    payload = os.urandom(int(args.size_mb * 1024 * 1024))
+    order_id = bench.create_order()
+    file_id, _ = bench.upload(order_id, payload)
+    bench.download(order_id, file_id)  # warm the page cache / WiredTiger cache
+
+    print(f"📦 {args.rounds} x {args.transfers} téléchargements simultanés de {args.size_mb} MB")
+    cpu_before = read_cpu_seconds(args.server_pid)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.transfers) as pool:
+        downloads = list(pool.map(lambda _: bench.download(order_id, file_id), range(args.rounds * args.transfers)))
+    elapsed = time.perf_counter() - started
+    cpu_seconds = read_cpu_seconds(args.server_pid) - cpu_before
+
+    served_gb = sum(received for received, _ in downloads) / (1024 ** 3)
+    print(f"   ⬇️  Débit agrégé:          {served_gb * 1024 / elapsed:8.1f} MB/s")
+    print(f"   🔥 CPU serveur:           {cpu_seconds:8.2f} s")
+    print(f"   📈 CPU par GB servi:      {cpu_seconds / served_gb:8.2f} s/GB")
+    print("   (le CPU de mongod n'est pas compté avec le backend gridfs)")
+
+async def time_gridfs_transfers(storage, payload, files, concurrency):
+    """Upload then download files copies of payload, at most concurrency at a time.
+    Returns per-file upload and download latencies and each phase's wall time, in seconds."""
+    semaphore = asyncio.Semaphore(concurrency)
+    piece = 1024 * 1024  # what the upload path hands to the writer at a time
+
+    async def upload(index):
+        async with semaphore:
+            started = time.perf_counter()
+            writer = storage.open_writer(f"benchmark-{index}.bin")
+            for offset in range(0, len(payload), piece):
+                await writer.write(payload[offset:offset + piece])
+            await writer.close({})
+            return writer.file_id, time.perf_counter() - started
+
+    async def download(file_id):
+        async with semaphore:
+            started = time.perf_counter()
+            stored = await storage.open(file_id)
+            received = 0
+            async for chunk in stored.iter_range():
+                received += len(chunk)
+            if received != len(payload):
+                raise RuntimeError(f"{file_id}: {received} octets lus sur {len(payload)}")
+            return time.perf_counter() - started
+
+    started = time.perf_counter()
+    uploads = await asyncio.gather(*(upload(index) for index in range(files)))
+    upload_wall = time.perf_counter() - started
+    started = time.perf_counter()
+    downloads = await asyncio.gather(*(download(file_id) for file_id, _ in uploads))
+    download_wall = time.perf_counter() - started
+    return [seconds for _, seconds in uploads], upload_wall, downloads, download_wall
+
+async def run_gridfs_async(args):
+    # Imported here: the other modes only talk to the HTTP API
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from server import GridFSStorage, client, open_gridfs_bucket
+
+    database = client[os.environ.get("BENCHMARK_MONGO_DB", "dmr_storage_benchmark")]
+    sizes_mb = [float(size) for size in args.sizes_mb.split(",")]
+    chunk_sizes_kb = [int(size) for size in args.chunk_kb.split(",")]
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+
+    print(f"📦 {args.files} fichiers par mesure, base {database.name}")
+    print(f"   {'chunk':>7} {'taille':>7} {'conc.':>5} │ {'⬆️ MB/s':>8} {'p99 ms':>8} │ {'⬇️ MB/s':>8} {'p99 ms':>8} │ {'chunks/fichier':>14}")
+    try:
+        for chunk_kb in chunk_sizes_kb:
+            bucket_name = f"bench_{chunk_kb}kb"
+            storage = GridFSStorage(open_gridfs_bucket(database, bucket_name, chunk_kb * 1024), database[f"{bucket_name}.files"])
+            for size_mb in sizes_mb:
+                payload = os.urandom(int(size_mb * 1024 * 1024))
+                for concurrency in concurrency_levels:
+                    upload_times, upload_wall, download_times, download_wall = await time_gridfs_transfers(
+                        storage, payload, args.files, concurrency
+                    )
+                    total_mb = size_mb * args.files
+                    chunk_docs = await database[f"{bucket_name}.chunks"].count_documents({})
+                    file_docs = await database[f"{bucket_name}.files"].count_documents({})
+                    print(
+                        f"   {chunk_kb:>5}KB {size_mb:>5.1f}MB {concurrency:>5} │"
+                        f" {total_mb / upload_wall:>8.1f} {percentile(upload_times, 99) * 1000:>8.1f} │"
+                        f" {total_mb / download_wall:>8.1f} {percentile(download_times, 99) * 1000:>8.1f} │"
+                        f" {chunk_docs / max(file_docs, 1):>14.1f}"
+                    )
+                    # Each measurement starts from an empty bucket
+                    await database[f"{bucket_name}.files"].drop()
+                    await database[f"{bucket_name}.chunks"].drop()
+    finally:
+        await client.drop_database(database.name)
+        client.close()
+
+def run_gridfs(args):
+    """Raw GridFS upload/download throughput for several chunk sizes, file sizes and concurrency levels"""
+    asyncio.run(run_gridfs_async(args))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks du stockage de fichiers")
+    parser.add_argument("mode", choices=["latency", "uploads", "serve", "gridfs"])
+    parser.add_argument("--url", default=os.environ.get("BENCHMARK_URL", "http://localhost:8001"))
+    parser.add_argument("--size-mb", type=float, default=8.0)
+    parser.add_argument("--transfers", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=8, help="Vagues de téléchargements (mode serve)")
+    parser.add_argument("--server-pid", type=int, help="PID du processus uvicorn (modes uploads et serve)")
+    parser.add_argument("--sizes-mb", default="1,4,10", help="Tailles de fichier testées (mode gridfs)")
+    parser.add_argument("--chunk-kb", default="255,1024,4096", help="Tailles de chunk GridFS testées (mode gridfs)")
+    parser.add_argument("--concurrency", default="1,8", help="Transferts simultanés testés (mode gridfs)")
+    parser.add_argument("--files", type=int, default=32, help="Fichiers par mesure (mode gridfs)")
+    args = parser.parse_args()
+
+    print("📊 DMR DÉVELOPPEMENT - Benchmark stockage")
+    print("=" * 50)
+
+    if args.mode == "gridfs":
+        run_gridfs(args)
+        return
+
+    bench = StorageBenchmark(
+        args.url,
+        os.environ.get("BENCHMARK_ADMIN_EMAIL", "admin@test.com"),
+        os.environ.get("BENCHMARK_ADMIN_PASSWORD", "admin123"),
+    )
+    try:
+        if args.mode == "latency":
+            run_latency(bench, args)
+        elif args.mode == "uploads":
+            run_uploads(bench, args)
+        elif args.mode == "serve":
+            run_serve(bench, args)
+    finally:
+        bench.cleanup()
+
+if __name__ == "__main__":
+    main()
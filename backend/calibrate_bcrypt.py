@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Script pour mesurer le coût bcrypt sur cette machine et choisir BCRYPT_ROUNDS
+Usage: python calibrate_bcrypt.py [temps_cible_ms]
+"""
+
+import os
+import sys
+
+# Add the backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from server import (
+    BCRYPT_MIN_ROUNDS,
+    BCRYPT_MAX_ROUNDS,
+    BCRYPT_ROUNDS,
+    calibrate_bcrypt_rounds,
+    time_bcrypt_rounds,
+)
+
+def main():
+    target_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 250.0
+
+    print("🔐 DMR DÉVELOPPEMENT - Calibration du coût bcrypt")
+    print("=" * 50)
+    print(f"🎯 Temps cible par hash: {target_ms:.0f} ms")
+    print(f"⚙️  BCRYPT_ROUNDS actuel: {BCRYPT_ROUNDS}")
+    print("")
+
+    for rounds in range(BCRYPT_MIN_ROUNDS, BCRYPT_MAX_ROUNDS + 1):
+        elapsed = time_bcrypt_rounds(rounds)
+        marker = "✅" if elapsed <= target_ms else "❌"
+        print(f"   {marker} coût {rounds:2d}: {elapsed:8.1f} ms")
+        if elapsed > target_ms * 4:
+            break
+
+    recommended = calibrate_bcrypt_rounds(target_ms)
+    print("")
+    print(f"📋 Coût recommandé: {recommended}")
+    print(f"   Ajoutez BCRYPT_ROUNDS={recommended} dans backend/.env")
+    print("   (ou BCRYPT_TARGET_MS pour calibrer à chaque démarrage)")
+    print("   Les mots de passe existants seront re-hashés à la prochaine connexion.")
+
+if __name__ == "__main__":
+    main()
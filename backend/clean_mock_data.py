@@ -7,28 +7,13 @@ Usage: python clean_mock_data.py
 import asyncio
 import os
 import sys
-from motor.motor_asyncio import AsyncIOMotorClient
-import gridfs
-from pymongo import MongoClient
 import re
 
 # Add the backend directory to path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from dotenv import load_dotenv
-load_dotenv()
-
-# MongoDB connection
-mongo_url = os.getenv("MONGO_URL", "mongodb://localhost:27017")
-db_name = os.getenv("MONGO_DB_NAME", "dmr_production_0f961c74")
-
-client = AsyncIOMotorClient(mongo_url)
-db = client[db_name]
-
-# GridFS for file cleanup
-sync_client = MongoClient(mongo_url)
-sync_db = sync_client[db_name]
-fs = gridfs.GridFS(sync_db)
+# Stored files can be shared between orders: they are released, not deleted outright
+from server import client, db, release_order_file
 
 async def clean_mock_data():
     """Clean all mock/test data from database"""
@@ -100,19 +85,20 @@ async def clean_mock_data():
         if any(pattern in service_name for pattern in test_patterns):
             test_orders.append(order)
     
-    # Clean associated files from GridFS
+    # Release associated files: content still used by another order is kept
     for order in test_orders:
         files = order.get('files', [])
         for file_info in files:
             file_id = file_info.get('file_id')
             if file_id:
                 try:
-                    fs.delete(file_id)
-                    print(f"   🗂️  Supprimé fichier: {file_info.get('filename', 'Unknown')}")
+                    await release_order_file(file_id)
+                    print(f"   🗂️  Libéré fichier: {file_info.get('filename', 'Unknown')}")
                 except Exception as e:
                     print(f"   ⚠️  Erreur suppression fichier {file_id}: {str(e)}")
         
         await db.orders.delete_one({"id": order["id"]})
+        await db.order_files.delete_many({"order_id": order["id"]})
         print(f"   ❌ Supprimé commande: {order.get('order_number', order['id'])}")
         total_deleted += 1
     
@@ -168,7 +154,6 @@ async def clean_mock_data():
 async def main():
     await clean_mock_data()
     client.close()
-    sync_client.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
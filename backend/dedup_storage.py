@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Script pour dédupliquer les fichiers GridFS existants (un seul exemplaire par contenu)
+Usage: python dedup_storage.py [--dry-run]
+
+Les fichiers envoyés depuis l'activation de la déduplication sont déjà partagés;
+ce script indexe les fichiers plus anciens, fusionne les doublons et met à jour
+les commandes qui les référencent.
+"""
+
+import asyncio
+import hashlib
+import os
+import sys
+
+# Add the backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bson import ObjectId
+from datetime import datetime
+
+from server import client, db, fs, get_storage_report, init_db
+
+async def file_digest(file_doc) -> str:
+    """SHA-256 of a stored file, from its metadata or by streaming it once"""
+    digest = (file_doc.get("metadata") or {}).get("sha256")
+    if digest:
+        return digest
+    sha256 = hashlib.sha256()
+    grid_out = await fs.open_download_stream(file_doc["_id"])
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            break
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+async def dedup_storage(dry_run: bool):
+    print("🧬 DMR DÉVELOPPEMENT - Déduplication du stockage")
+    print("=" * 50)
+    if dry_run:
+        print("🔍 Mode simulation: aucune modification")
+
+    # How many order entries point at each stored file, and whose orders they are
+    references = {}
+    owners = {}
+    async for row in db.orders.aggregate([
+        {"$unwind": "$files"},
+        {"$group": {"_id": "$files.file_id", "count": {"$sum": 1}, "owners": {"$addToSet": "$user_id"}}}
+    ]):
+        references[row["_id"]] = row["count"]
+        owners[row["_id"]] = row["owners"]
+
+    indexed = set()
+    async for blob in db.blobs.find({}, {"file_id": 1}):
+        indexed.add(blob["file_id"])
+
+    # Group the files that are not indexed yet by content
+    groups = {}
+    scanned = 0
+    async for file_doc in db.fs.files.find({}, {"length": 1, "metadata": 1}).sort("uploadDate", 1):
+        file_id = str(file_doc["_id"])
+        if file_id in indexed:
+            continue
+        scanned += 1
+        digest = await file_digest(file_doc)
+        groups.setdefault(digest, []).append((file_id, file_doc["length"]))
+    print(f"📂 {scanned} fichiers non indexés, {len(groups)} contenus distincts")
+
+    saved_bytes = 0
+    merged = 0
+    unreferenced = 0
+    for digest, files in groups.items():
+        refcount = sum(references.get(file_id, 0) for file_id, _ in files)
+        if refcount == 0:
+            # Nothing points at these copies: left for the orphan cleanup
+            unreferenced += len(files)
+            continue
+
+        existing = await db.blobs.find_one({"sha256": digest})
+        canonical = existing["file_id"] if existing else next(
+            file_id for file_id, _ in files if references.get(file_id, 0)
+        )
+        duplicates = [(file_id, length) for file_id, length in files if file_id != canonical]
+        merged += len(duplicates)
+        saved_bytes += sum(length for _, length in duplicates)
+        if dry_run:
+            continue
+
+        for duplicate_id, _ in duplicates:
+            if references.get(duplicate_id, 0):
+                await db.orders.update_many(
+                    {"files.file_id": duplicate_id},
+                    {"$set": {"files.$[f].file_id": canonical}},
+                    array_filters=[{"f.file_id": duplicate_id}]
+                )
+                await db.order_files.update_many({"file_id": duplicate_id}, {"$set": {"file_id": canonical}})
+            await fs.delete(ObjectId(duplicate_id))
+
+        blob_owners = sorted({owner for file_id, _ in files for owner in owners.get(file_id, [])})
+        if existing:
+            await db.blobs.update_one(
+                {"sha256": digest},
+                {"$inc": {"refcount": refcount}, "$addToSet": {"owners": {"$each": blob_owners}}}
+            )
+        else:
+            length = next(length for file_id, length in files if file_id == canonical)
+            await db.blobs.insert_one({
+                "file_id": canonical,
+                "sha256": digest,
+                "length": length,
+                "refcount": refcount,
+                "owners": blob_owners,
+                "created_at": datetime.utcnow()
+            })
+            # Older files have no digest yet; downloads use it as their ETag
+            await db.fs.files.update_one(
+                {"_id": ObjectId(canonical)},
+                {"$set": {"metadata.sha256": digest}}
+            )
+
+    print(f"   ✅ {merged} doublons {'à fusionner' if dry_run else 'fusionnés'}")
+    print(f"   💾 {saved_bytes / (1024 * 1024):.2f} MB {'récupérables' if dry_run else 'récupérés'}")
+    if unreferenced:
+        print(f"   ⚠️  {unreferenced} fichiers sans commande associée (ignorés)")
+
+    report = await get_storage_report()
+    print("\n📊 Stockage dédupliqué:")
+    print(f"   Blobs: {report['blobs']} pour {report['references']} références")
+    print(f"   Stocké: {report['stored_bytes'] / (1024 * 1024):.2f} MB")
+    print(f"   Économisé: {report['dedup_saved_bytes'] / (1024 * 1024):.2f} MB")
+
+async def main():
+    await init_db()
+    await dedup_storage("--dry-run" in sys.argv)
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -46,6 +46,7 @@ async def final_cleanup():
     # 3. Remove ALL orders
     print("🗑️  Suppression de toutes les commandes...")
     orders_deleted = await db.orders.delete_many({})
+    await db.order_files.delete_many({})
     print(f"   ✅ {orders_deleted.deleted_count} commandes supprimées")
     
     # 4. Remove ALL notifications
@@ -62,6 +63,8 @@ async def final_cleanup():
     print("🗑️  Nettoyage des fichiers GridFS...")
     files_deleted = await db.fs.files.delete_many({})
     chunks_deleted = await db.fs.chunks.delete_many({})
+    # The dedup index would otherwise point new uploads at the deleted files
+    await db.blobs.delete_many({})
     print(f"   ✅ {files_deleted.deleted_count} fichiers supprimés")
     print(f"   ✅ {chunks_deleted.deleted_count} chunks supprimés")
     
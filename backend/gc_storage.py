@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Script pour supprimer les fichiers GridFS que plus rien ne référence
+Usage: python gc_storage.py [--dry-run] [--batch-size 500] [--max-batches 0] [--grace-hours 24]
+
+Un fichier est conservé tant qu'une commande, une version delta (comme base),
+une session d'upload ou un export le référence, et pendant --grace-hours après
+son envoi (upload en cours d'enregistrement). L'entrée de l'index de
+déduplication d'un fichier supprimé est retirée avec lui.
+Le parcours reprend où le passage précédent s'est arrêté: avec --max-batches,
+chaque passage ne traite que ce nombre de lots. Les chunks sans fichier
+(uploads interrompus) sont supprimés en fin de parcours.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+# Add the backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bson import ObjectId
+
+from server import client, db, init_db, release_blob
+
+GC_STATE_ID = "gridfs_orphans"
+
+async def pinned_file_ids() -> set:
+    """Files held by something other than an order or a blob"""
+    pinned = set()
+    async for session in db.upload_sessions.find({}, {"chunks": 1}):
+        pinned.update(chunk["file_id"] for chunk in session.get("chunks", {}).values())
+    async for export in db.exports.find({}, {"entries.file_id": 1}):
+        pinned.update(entry["file_id"] for entry in export.get("entries", []))
+    return pinned
+
+async def referenced_in(file_ids: list, cutoff: datetime) -> set:
+    """Which of file_ids an order, or a delta version stored against them, still points at"""
+    referenced = set()
+    async for order in db.orders.find({"files.file_id": {"$in": file_ids}}, {"files.file_id": 1}):
+        referenced.update(f["file_id"] for f in order.get("files", []))
+    # A blob row alone is no reference: rows outlive orders deleted without releasing them.
+    # Only a delta needs another file; it releases its base once it is collected itself.
+    async for blob in db.blobs.find({"delta_base": {"$in": file_ids}}, {"delta_base": 1}):
+        referenced.add(blob["delta_base"])
+    # Content just deduplicated onto: its order entry may not be written yet
+    async for blob in db.blobs.find({"file_id": {"$in": file_ids}, "referenced_at": {"$gte": cutoff}}, {"file_id": 1}):
+        referenced.add(blob["file_id"])
+    return referenced
+
+async def delete_files(file_ids: list, cutoff: datetime) -> list:
+    """Delete a batch of GridFS files with one query per collection instead of one fs.delete each.
+
+    A file whose blob was deduplicated onto since it was found unreferenced is
+    kept. Returns the ids actually deleted.
+    """
+    rows = {
+        blob["file_id"]: blob.get("delta_base")
+        async for blob in db.blobs.find({"file_id": {"$in": file_ids}}, {"file_id": 1, "delta_base": 1})
+    }
+    # The dedup index must not send a new upload to a deleted file. The
+    # condition is checked again here: register_blob may have taken a
+    # reference since referenced_in ran.
+    await db.blobs.delete_many({
+        "file_id": {"$in": list(rows)},
+        "$or": [{"referenced_at": {"$lt": cutoff}}, {"referenced_at": {"$exists": False}}]
+    })
+    kept = {blob["file_id"] async for blob in db.blobs.find({"file_id": {"$in": list(rows)}}, {"file_id": 1})}
+    deleted = [file_id for file_id in file_ids if file_id not in kept]
+    object_ids = [ObjectId(file_id) for file_id in deleted]
+    # Files first, as GridFS does: a file without chunks is never left readable
+    await db.fs.files.delete_many({"_id": {"$in": object_ids}})
+    await db.fs.chunks.delete_many({"files_id": {"$in": object_ids}})
+    for file_id in deleted:
+        if rows.get(file_id):
+            await release_blob(rows[file_id])
+    return deleted
+
+async def collect_orphan_files(args, cutoff: datetime, pinned: set) -> tuple:
+    """Sweep fs.files in _id order from the saved position. Returns (files, bytes, finished)."""
+    state = await db.gc_state.find_one({"_id": GC_STATE_ID}) or {}
+    query = {"uploadDate": {"$lt": cutoff}}
+    if state.get("last_id"):
+        query["_id"] = {"$gt": state["last_id"]}
+
+    orphans = reclaimed = batches = 0
+    while not args.max_batches or batches < args.max_batches:
+        batch = await db.fs.files.find(query, {"length": 1}).sort("_id", 1).limit(args.batch_size).to_list(args.batch_size)
+        if not batch:
+            if not args.dry_run:
+                await db.gc_state.delete_one({"_id": GC_STATE_ID})
+            return orphans, reclaimed, True
+        batches += 1
+
+        file_ids = [str(file_doc["_id"]) for file_doc in batch]
+        referenced = await referenced_in(file_ids, cutoff)
+        unreachable = [
+            file_doc for file_doc in batch
+            if str(file_doc["_id"]) not in referenced and str(file_doc["_id"]) not in pinned
+        ]
+        if not args.dry_run and unreachable:
+            deleted = set(await delete_files([str(file_doc["_id"]) for file_doc in unreachable], cutoff))
+            unreachable = [file_doc for file_doc in unreachable if str(file_doc["_id"]) in deleted]
+        orphans += len(unreachable)
+        reclaimed += sum(file_doc["length"] for file_doc in unreachable)
+        if not args.dry_run:
+            await db.gc_state.update_one(
+                {"_id": GC_STATE_ID}, {"$set": {"last_id": batch[-1]["_id"], "updated_at": datetime.utcnow()}}, upsert=True
+            )
+        query["_id"] = {"$gt": batch[-1]["_id"]}
+    return orphans, reclaimed, False
+
+async def collect_orphan_chunks(args, cutoff: datetime) -> tuple:
+    """Chunks whose fs.files entry is gone. Returns (files, bytes)."""
+    # Every stored file has a chunk 0; its ObjectId tells when the upload started
+    orphans = reclaimed = 0
+    query = {"n": 0, "files_id": {"$lt": ObjectId.from_datetime(cutoff.replace(tzinfo=timezone.utc))}}
+    cursor = db.fs.chunks.find(query, {"files_id": 1}).sort("files_id", 1)
+    while True:
+        batch = [chunk["files_id"] for chunk in await cursor.to_list(args.batch_size)]
+        if not batch:
+            return orphans, reclaimed
+        existing = {file_doc["_id"] async for file_doc in db.fs.files.find({"_id": {"$in": batch}}, {"_id": 1})}
+        missing = [files_id for files_id in batch if files_id not in existing]
+        if not missing:
+            continue
+        sizes = await db.fs.chunks.aggregate([
+            {"$match": {"files_id": {"$in": missing}}},
+            {"$group": {"_id": None, "bytes": {"$sum": {"$binarySize": "$data"}}}}
+        ]).to_list(1)
+        orphans += len(missing)
+        reclaimed += sizes[0]["bytes"] if sizes else 0
+        if not args.dry_run:
+            await db.fs.chunks.delete_many({"files_id": {"$in": missing}})
+
+async def gc_storage(args):
+    print("🧹 DMR DÉVELOPPEMENT - Nettoyage des fichiers orphelins")
+    print("=" * 50)
+    if args.dry_run:
+        print("🔍 Mode simulation: aucune modification")
+
+    cutoff = datetime.utcnow() - timedelta(hours=args.grace_hours)
+    pinned = await pinned_file_ids()
+    files, file_bytes, finished = await collect_orphan_files(args, cutoff, pinned)
+    print(f"   🗑️  {files} fichiers orphelins {'à supprimer' if args.dry_run else 'supprimés'} ({file_bytes / (1024 * 1024):.2f} MB)")
+
+    if finished:
+        chunks, chunk_bytes = await collect_orphan_chunks(args, cutoff)
+        print(f"   🧩 {chunks} uploads interrompus {'à supprimer' if args.dry_run else 'supprimés'} ({chunk_bytes / (1024 * 1024):.2f} MB)")
+        file_bytes += chunk_bytes
+    else:
+        print("   ⏸️  Parcours incomplet: relancer pour continuer")
+    print(f"   💾 {file_bytes / (1024 * 1024):.2f} MB {'récupérables' if args.dry_run else 'récupérés'}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Suppression des fichiers GridFS orphelins")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--max-batches", type=int, default=0, help="Lots par passage (0: tout parcourir)")
+    parser.add_argument("--grace-hours", type=float, default=24.0)
+    args = parser.parse_args()
+    try:
+        await init_db()
+        await gc_storage(args)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
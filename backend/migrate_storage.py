@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Script pour déplacer les fichiers stockés d'un backend à l'autre (gridfs <-> local)
+Usage: python migrate_storage.py <source> <destination> [--dry-run] [--delete-source]
+
+Les identifiants sont conservés, les commandes n'ont donc pas à être modifiées.
+Procédure: migrer, basculer FILE_STORAGE_BACKEND sur la destination et redémarrer,
+relancer la migration pour les fichiers reçus entre-temps, puis une dernière fois
+avec --delete-source. Les fichiers déjà présents à destination sont ignorés.
+"""
+
+import asyncio
+import hashlib
+import os
+import sys
+
+# Add the backend directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from server import client, decode_delta, get_storage_backend, zstandard
+
+async def copy_file(source, destination, file_id: str) -> int:
+    """Copy one file with the same id, checking its digest on the way. Returns its size."""
+    stored = await source.open(file_id)
+    writer = destination.open_writer(stored.filename, file_id=file_id)
+    sha256 = hashlib.sha256()
+    # Compressed files are copied as they are; only the digest check decompresses
+    decompressor = zstandard.ZstdDecompressor().decompressobj() if stored.encoding == "zstd" else None
+    # Deltas are small: their base may not be copied yet, so only their patches are checked
+    delta = bytearray() if stored.encoding == "delta" else None
+    try:
+        async for chunk in stored.iter_range():
+            if delta is not None:
+                delta += chunk
+            else:
+                sha256.update(decompressor.decompress(chunk) if decompressor else chunk)
+            await writer.write(chunk)
+        expected = stored.metadata.get("sha256")
+        if delta is not None:
+            if decode_delta(bytes(delta))[0] != stored.content_length:
+                raise ValueError(f"Corrupt delta for {file_id}")
+        elif expected and expected != sha256.hexdigest():
+            raise ValueError(f"SHA-256 mismatch for {file_id}")
+        await writer.close(stored.metadata)
+    except BaseException:
+        await writer.abort()
+        raise
+    return stored.length
+
+async def migrate_storage(source_name: str, destination_name: str, dry_run: bool, delete_source: bool):
+    print("🚚 DMR DÉVELOPPEMENT - Migration du stockage")
+    print("=" * 50)
+    source = get_storage_backend(source_name)
+    destination = get_storage_backend(destination_name)
+    print(f"📦 {source.name} → {destination.name}")
+    if dry_run:
+        print("🔍 Mode simulation: aucune modification")
+
+    copied = skipped = failed = deleted = 0
+    copied_bytes = 0
+    async for file_id in source.iter_file_ids():
+        try:
+            await destination.open(file_id)
+            already_there = True
+        except FileNotFoundError:
+            already_there = False
+
+        if already_there:
+            skipped += 1
+        elif dry_run:
+            copied += 1
+            copied_bytes += (await source.open(file_id)).length
+            continue
+        else:
+            try:
+                copied_bytes += await copy_file(source, destination, file_id)
+                copied += 1
+            except (FileNotFoundError, ValueError) as e:
+                print(f"   ❌ {file_id}: {e}")
+                failed += 1
+                continue
+
+        if delete_source and not dry_run:
+            await source.delete(file_id)
+            deleted += 1
+
+    print(f"   ✅ {copied} fichiers {'à copier' if dry_run else 'copiés'} ({copied_bytes / (1024 * 1024):.2f} MB)")
+    print(f"   ⏭️  {skipped} déjà présents à destination")
+    if deleted:
+        print(f"   🗑️  {deleted} supprimés de {source.name}")
+    if failed:
+        print(f"   ⚠️  {failed} échecs (laissés dans {source.name})")
+
+async def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) != 2 or args[0] == args[1]:
+        print(__doc__)
+        sys.exit(1)
+    try:
+        await migrate_storage(args[0], args[1], "--dry-run" in sys.argv, "--delete-source" in sys.argv)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
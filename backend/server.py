@@ -1,24 +1,49 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Query, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Form, Query, Response, Request, BackgroundTasks
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
 from fastapi.exception_handlers import http_exception_handler
-from jose import JWTError
 from bson import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.concurrency import run_in_threadpool
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
 import os
+import json
+import re
 import logging
 from pathlib import Path
+from multipart.multipart import MultipartParser, parse_options_header
+from urllib.parse import urlencode
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional
 import uuid
 from datetime import datetime, timedelta
 import jwt
 import bcrypt
-import gridfs
-from pymongo import MongoClient
-import io
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import time
+import hmac
+import hashlib
+import secrets
+import math
+import shutil
+import tempfile
+import zipfile
+import zlib
+import struct
+from array import array
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # optional: files are stored uncompressed without it
+    zstandard = None
 
 load_dotenv()
 
@@ -29,15 +54,291 @@ db_name = os.getenv("MONGO_DB_NAME", "dmr_production_0f961c74")
 client = AsyncIOMotorClient(mongo_url)
 db = client[db_name]
 
-# GridFS for file storage
-sync_client = MongoClient(mongo_url)
-sync_db = sync_client[db_name]
-fs = gridfs.GridFS(sync_db)
+# GridFS bucket for the "gridfs" storage backend, on the same async client so file I/O never blocks the event loop.
+# The chunk size only applies to files written from now on: each file keeps the one it was stored with.
+GRIDFS_CHUNK_SIZE_BYTES = int(os.environ.get('GRIDFS_CHUNK_SIZE_BYTES', str(255 * 1024)))
+
+def open_gridfs_bucket(database, bucket_name: str = "fs", chunk_size_bytes: int = GRIDFS_CHUNK_SIZE_BYTES):
+    # Each chunk is one document, and documents are capped at 16MB
+    if not 0 < chunk_size_bytes <= 15 * 1024 * 1024:
+        raise ValueError(f"GridFS chunk size must be between 1 byte and 15MB, got {chunk_size_bytes}")
+    return AsyncIOMotorGridFSBucket(database, bucket_name=bucket_name, chunk_size_bytes=chunk_size_bytes)
+
+fs = open_gridfs_bucket(db)
 
 # JWT settings
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-this')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get('REFRESH_TOKEN_EXPIRE_DAYS', '14'))
+
+# File uploads
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 10MB
+# Room for multipart boundaries, part headers and the small form fields
+MAX_UPLOAD_OVERHEAD_BYTES = 64 * 1024
+MAX_FORM_FIELD_BYTES = 16 * 1024
+
+# File storage backend: "gridfs" (MongoDB) or "local" (sharded directories on disk)
+FILE_STORAGE_BACKEND = os.environ.get('FILE_STORAGE_BACKEND', 'gridfs')
+LOCAL_STORAGE_PATH = Path(os.environ.get('LOCAL_STORAGE_PATH', str(Path(__file__).parent / 'file_storage')))
+LOCAL_STORAGE_READ_BYTES = 256 * 1024
+
+# Stored files are zstd-compressed when FILE_COMPRESSION is "zstd" and the
+# zstandard package is installed; "none" stores them as uploaded
+FILE_COMPRESSION = os.environ.get('FILE_COMPRESSION', 'zstd')
+FILE_COMPRESSION_LEVEL = int(os.environ.get('FILE_COMPRESSION_LEVEL', '3'))
+FILE_COMPRESSION_ENABLED = FILE_COMPRESSION == "zstd" and zstandard is not None
+
+# Hot-file cache in front of the storage backend: recently uploaded or read files
+# are served from memory, then from a local-disk tier. The disk tier is off by
+# default when the backend already is local disk.
+FILE_CACHE_MEMORY_BYTES = int(os.environ.get('FILE_CACHE_MEMORY_BYTES', str(64 * 1024 * 1024)))
+FILE_CACHE_DISK_BYTES = int(os.environ.get(
+    'FILE_CACHE_DISK_BYTES', '0' if FILE_STORAGE_BACKEND == 'local' else str(1024 * 1024 * 1024)
+))
+FILE_CACHE_DISK_PATH = Path(os.environ.get('FILE_CACHE_DISK_PATH', str(Path(tempfile.gettempdir()) / 'dmr_file_cache')))
+FILE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('FILE_CACHE_MAX_ENTRY_BYTES', str(16 * 1024 * 1024)))
+
+# Tuned versions are stored as patches against the order's original when the
+# changed blocks add up to less than DELTA_MAX_RATIO of the file and DELTA_MAX_PATCH_BYTES;
+# patches are held in memory while diffing and rebuilding
+DELTA_BLOCK_BYTES = 256
+DELTA_MAX_RATIO = float(os.environ.get('DELTA_MAX_RATIO', '0.25'))
+DELTA_MAX_PATCH_BYTES = int(os.environ.get('DELTA_MAX_PATCH_BYTES', str(FILE_CACHE_MAX_ENTRY_BYTES)))
+DELTA_CACHE_MAX_ENTRIES = int(os.environ.get('DELTA_CACHE_MAX_ENTRIES', '8'))
+DELTA_CACHE_TTL_SECONDS = float(os.environ.get('DELTA_CACHE_TTL_SECONDS', '600'))
+
+# File downloads - ids never change content, so clients may cache forever
+FILE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+MAX_BYTE_RANGES = 16
+
+# Resumable uploads: files up to UPLOAD_SESSION_MAX_BYTES sent as numbered chunks,
+# each staged in storage as it arrives
+UPLOAD_SESSION_MAX_BYTES = int(os.environ.get('UPLOAD_SESSION_MAX_BYTES', str(512 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+UPLOAD_SESSION_EXPIRE_HOURS = int(os.environ.get('UPLOAD_SESSION_EXPIRE_HOURS', '24'))
+UPLOAD_SESSION_GC_SECONDS = int(os.environ.get('UPLOAD_SESSION_GC_SECONDS', '900'))
+# A completion that has not finished by then died with its worker: the session is reopened
+UPLOAD_SESSION_FINALIZE_TIMEOUT_MINUTES = int(os.environ.get('UPLOAD_SESSION_FINALIZE_TIMEOUT_MINUTES', '30'))
+
+# Post-upload analysis: new content is queued and analyzed by a few background
+# workers, so uploads return as soon as the file is stored
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', '2'))
+ANALYSIS_QUEUE_SIZE = int(os.environ.get('ANALYSIS_QUEUE_SIZE', '1000'))
+# Larger files only have their first ANALYSIS_MAX_BYTES analyzed
+ANALYSIS_MAX_BYTES = int(os.environ.get('ANALYSIS_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# Bulk exports
+EXPORT_MAX_FILES = int(os.environ.get('EXPORT_MAX_FILES', '5000'))
+EXPORT_EXPIRE_HOURS = int(os.environ.get('EXPORT_EXPIRE_HOURS', '24'))
+EXPORT_READ_CONCURRENCY = int(os.environ.get('EXPORT_READ_CONCURRENCY', '4'))
+EXPORT_PREFETCH_BYTES = int(os.environ.get('EXPORT_PREFETCH_BYTES', str(64 * 1024 * 1024)))
+
+# Signed download URLs
+DOWNLOAD_URL_EXPIRE_SECONDS = int(os.environ.get('DOWNLOAD_URL_EXPIRE_SECONDS', '300'))
+DOWNLOAD_URL_KEY = hmac.new(SECRET_KEY.encode('utf-8'), b"download-url", hashlib.sha256).digest()
+
+# User cache settings
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '1024'))
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '60'))
+
+class LRUCache:
+    """Bounded in-process LRU cache with per-entry TTL and hit/miss counters"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        # Bumped on every invalidation so loads started before a write can't
+        # repopulate the cache with the old value
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, epoch: Optional[int] = None, ttl_seconds: Optional[float] = None):
+        if self.max_entries <= 0:
+            return
+        if epoch is not None and epoch != self.epoch:
+            return
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.epoch += 1
+        self.invalidations += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self.epoch += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+# Decoded users keyed by user id, shared by every authenticated request
+user_cache = LRUCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS)
+
+# Token versions keyed by user id. A token is only accepted while its "tv"
+# claim matches, so bumping the version revokes every outstanding token.
+TOKEN_VERSION_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_VERSION_CACHE_MAX_ENTRIES', '10000'))
+TOKEN_VERSION_CACHE_TTL_SECONDS = float(os.environ.get('TOKEN_VERSION_CACHE_TTL_SECONDS', '300'))
+REVOKED_TOKEN_VERSION = -1
+token_version_cache = LRUCache(TOKEN_VERSION_CACHE_MAX_ENTRIES, TOKEN_VERSION_CACHE_TTL_SECONDS)
+
+# Login throttling - token buckets per client IP and per account email
+LOGIN_LIMITER_SLOTS = int(os.environ.get('LOGIN_LIMITER_SLOTS', '4096'))
+LOGIN_IP_BURST = float(os.environ.get('LOGIN_IP_BURST', '20'))
+LOGIN_IP_PER_MINUTE = float(os.environ.get('LOGIN_IP_PER_MINUTE', '30'))
+LOGIN_EMAIL_BURST = float(os.environ.get('LOGIN_EMAIL_BURST', '5'))
+LOGIN_EMAIL_PER_MINUTE = float(os.environ.get('LOGIN_EMAIL_PER_MINUTE', '5'))
+# Number of reverse proxies in front of the API whose X-Forwarded-For entry is trusted
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+
+class TokenBucketLimiter:
+    """Token buckets stored in fixed-size arrays.
+
+    Keys are hashed into a fixed number of slots, so memory stays constant no
+    matter how many distinct emails or IPs are seen. Two keys sharing a slot
+    share a bucket, which can only make the limit stricter.
+    """
+
+    def __init__(self, slots: int, burst: float, per_minute: float):
+        self.slots = slots
+        self.burst = burst
+        self.rate = per_minute / 60.0
+        self._tokens = array('d', [burst]) * slots
+        self._updated = array('d', [0.0]) * slots
+        # Per-process key so nobody can pick keys that collide with a victim's slot
+        self._hash_key = secrets.token_bytes(16)
+        self.allowed = 0
+        self.rejected = 0
+
+    def _slot(self, key: str) -> int:
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8, key=self._hash_key).digest()
+        return int.from_bytes(digest, 'little') % self.slots
+
+    def acquire(self, key: str) -> float:
+        """Take a token for key; return 0 if allowed, else seconds until one is available"""
+        slot = self._slot(key)
+        now = time.monotonic()
+        tokens = min(self.burst, self._tokens[slot] + (now - self._updated[slot]) * self.rate)
+        self._updated[slot] = now
+        if tokens >= 1.0:
+            self._tokens[slot] = tokens - 1.0
+            self.allowed += 1
+            return 0.0
+        self._tokens[slot] = tokens
+        self.rejected += 1
+        return (1.0 - tokens) / self.rate if self.rate > 0 else 60.0
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "burst": self.burst,
+            "per_minute": self.rate * 60.0,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+        }
+
+login_ip_limiter = TokenBucketLimiter(LOGIN_LIMITER_SLOTS, LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE)
+login_email_limiter = TokenBucketLimiter(LOGIN_LIMITER_SLOTS, LOGIN_EMAIL_BURST, LOGIN_EMAIL_PER_MINUTE)
+
+# Verified JWT claims keyed by the raw token. Polling clients present the
+# same token every few seconds, so most requests skip the signature check.
+JWT_CACHE_MAX_ENTRIES = int(os.environ.get('JWT_CACHE_MAX_ENTRIES', '4096'))
+JWT_CACHE_TTL_SECONDS = float(os.environ.get('JWT_CACHE_TTL_SECONDS', '300'))
+jwt_cache = LRUCache(JWT_CACHE_MAX_ENTRIES, JWT_CACHE_TTL_SECONDS)
+
+# Password hashing settings - bcrypt runs on its own bounded pool so a burst
+# of logins can't stall the event loop
+BCRYPT_MAX_WORKERS = int(os.environ.get('BCRYPT_MAX_WORKERS', '2'))
+BCRYPT_MAX_QUEUE = int(os.environ.get('BCRYPT_MAX_QUEUE', '16'))
+BCRYPT_RETRY_AFTER_SECONDS = int(os.environ.get('BCRYPT_RETRY_AFTER_SECONDS', '2'))
+
+class BoundedExecutor:
+    """Thread pool that rejects work once running + queued jobs hit a limit"""
+
+    def __init__(self, max_workers: int, max_queue: int, name: str):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _done(self, _future):
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def try_submit(self, func, *args):
+        """Return an awaitable for func(*args), or None if the pool is saturated"""
+        with self._lock:
+            if self.in_flight >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                return None
+            self.in_flight += 1
+        # The counter is released when the thread finishes, not when the caller
+        # stops waiting, so abandoned requests still count against the limit
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._done)
+        return asyncio.wrap_future(future)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+bcrypt_executor = BoundedExecutor(BCRYPT_MAX_WORKERS, BCRYPT_MAX_QUEUE, "bcrypt")
+
+# bcrypt cost factor for new hashes. When BCRYPT_TARGET_MS is set, startup
+# calibration replaces it with the highest cost that hashes within the target
+# on this machine. Stored hashes with another cost are upgraded at login.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+BCRYPT_TARGET_MS = float(os.environ.get('BCRYPT_TARGET_MS', '0'))
+BCRYPT_MIN_ROUNDS = 10
+BCRYPT_MAX_ROUNDS = 16
 
 # Create the main app without a prefix
 app = FastAPI()
@@ -45,15 +346,6 @@ app = FastAPI()
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Helper function to add CORS headers
-def add_cors_headers(response: Response):
-    """Add CORS headers to any response"""
-    response.headers["Access-Control-Allow-Origin"] = "https://engine-tune-portal.emergent.host"
-    response.headers["Access-Control-Allow-Credentials"] = "true"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "*"
-    return response
-
 # Custom exception handler for CORS
 async def cors_exception_handler(request, exc):
     """Handle HTTPException with CORS headers"""
@@ -108,6 +400,11 @@ class User(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_active: bool = True
 
+class Principal(BaseModel):
+    """Who a request comes from, as stated by its verified token"""
+    id: str
+    role: str
+
 class ServiceCreate(BaseModel):
     name: str
     price: float
@@ -136,6 +433,25 @@ class FileVersion(BaseModel):
     uploaded_at: datetime = Field(default_factory=datetime.utcnow)
     notes: Optional[str] = None
 
+class OrderFile(BaseModel):
+    """A file of an order, indexed on its own so lookups don't load the order"""
+    file_id: str
+    order_id: str
+    owner_id: str  # the order's client
+    version_type: str
+    filename: str
+    length: Optional[int] = None
+    sha256: Optional[str] = None
+    uploaded_by: str
+    uploaded_at: datetime
+    notes: Optional[str] = None
+
+class StorageClientUsage(BaseModel):
+    owner_id: str
+    files: int
+    bytes: int
+    last_upload_at: Optional[datetime] = None
+
 class Order(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     order_number: Optional[str] = None
@@ -189,17 +505,132 @@ class Message(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class UploadByHash(BaseModel):
+    sha256: str
+    filename: str
+    notes: Optional[str] = None
+
+class DownloadLink(BaseModel):
+    url: str
+    expires_at: datetime
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    length: int
+    sha256: Optional[str] = None  # checked when the session is completed
+    notes: Optional[str] = None
+    version_type: str = "v1"  # admin sessions only
+
+class UploadSessionStatus(BaseModel):
+    id: str
+    order_id: str
+    filename: str
+    length: int
+    chunk_size: int
+    chunk_count: int
+    received_chunks: List[int]
+    received_offsets: List[int]
+    received_bytes: int
+    missing_chunks: List[int]
+    state: str  # open, finalizing, completed
+    expires_at: datetime
+
+class ExportFilter(BaseModel):
+    uploaded_from: Optional[datetime] = None
+    uploaded_to: Optional[datetime] = None
+    status: Optional[str] = None
+    user_id: Optional[str] = None
+    version_types: Optional[List[str]] = None
+
+class ExportSummary(BaseModel):
+    id: str
+    orders: int
+    files: int
+    size: int
+    expires_at: datetime
+    url: str
 
 # No default services - all services must be created manually via UI
 DEFAULT_SERVICES = []
 
 # Helper functions
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+def hash_password(password: str, rounds: Optional[int] = None) -> str:
+    salt = bcrypt.gensalt(rounds=rounds or BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+def get_hash_rounds(hashed_password: str) -> Optional[int]:
+    """Cost factor of a stored "$2b$12$..." hash, or None if it can't be parsed"""
+    parts = hashed_password.split('$')
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+def time_bcrypt_rounds(rounds: int, samples: int = 3) -> float:
+    """Best-of-samples time in milliseconds to hash one password at the given cost"""
+    best = None
+    for _ in range(samples):
+        started = time.perf_counter()
+        hash_password("calibration-password", rounds=rounds)
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def calibrate_bcrypt_rounds(target_ms: float, samples: int = 3) -> int:
+    """Highest cost whose hash time stays within target_ms (never below BCRYPT_MIN_ROUNDS)"""
+    rounds = BCRYPT_MIN_ROUNDS
+    while rounds < BCRYPT_MAX_ROUNDS:
+        # Each extra round doubles the work, so stop before the next one overshoots
+        if time_bcrypt_rounds(rounds + 1, samples) > target_ms:
+            break
+        rounds += 1
+    return rounds
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+async def run_bcrypt(func, *args):
+    """Run a bcrypt helper on the bcrypt pool, failing fast with 503 when it is full"""
+    pending = bcrypt_executor.try_submit(func, *args)
+    if pending is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please retry shortly",
+            headers={"Retry-After": str(BCRYPT_RETRY_AFTER_SECONDS)},
+        )
+    return await pending
+
+def get_client_ip(request: Request) -> str:
+    """Client address, taking the entry added by our own proxies from X-Forwarded-For"""
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded and TRUSTED_PROXY_HOPS > 0:
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        if hops:
+            return hops[-min(TRUSTED_PROXY_HOPS, len(hops))]
+    return request.client.host if request.client else "unknown"
+
+def check_login_rate(request: Request, email: str):
+    """Reject a login attempt with 429 before any DB or bcrypt work if it is over the limit"""
+    retry_after = login_ip_limiter.acquire(get_client_ip(request))
+    if not retry_after:
+        retry_after = login_email_limiter.acquire(email.strip().lower())
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, please retry later",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+async def hash_password_async(password: str) -> str:
+    return await run_bcrypt(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await run_bcrypt(verify_password, plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -210,61 +641,144 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def create_user_token(user_doc: dict, expires_delta: Optional[timedelta] = None) -> str:
+    """Build an access token carrying the claims needed to authorize without a user lookup"""
+    return create_access_token(
+        data={
+            "sub": user_doc["id"],
+            "role": user_doc.get("role", "client"),
+            "tv": user_doc.get("token_version", 0),
+        },
+        expires_delta=expires_delta,
+    )
+
+def hash_refresh_token(refresh_token: str) -> str:
+    return hmac.new(SECRET_KEY.encode('utf-8'), refresh_token.encode('utf-8'), hashlib.sha256).hexdigest()
+
+async def issue_refresh_token(user_id: str, role: str, token_version: int, family_id: Optional[str] = None) -> str:
+    """Store a new refresh token (hashed) and return the raw value for the client"""
+    refresh_token = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    await db.refresh_tokens.insert_one({
+        "token_hash": hash_refresh_token(refresh_token),
+        "user_id": user_id,
+        "role": role,
+        "token_version": token_version,
+        # Every token rotated from the same login shares a family, so a replayed
+        # token can revoke the whole chain
+        "family_id": family_id or str(uuid.uuid4()),
+        "created_at": now,
+        "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        "used_at": None,
+    })
+    return refresh_token
+
+async def get_token_version(user_id: str) -> int:
+    """Current token version for user_id, from the in-memory version map when possible"""
+    version = token_version_cache.get(user_id)
+    if version is not None:
+        return version
+    epoch = token_version_cache.epoch
+    user_doc = await db.users.find_one({"id": user_id}, {"token_version": 1, "is_active": 1})
+    if user_doc is None or not user_doc.get("is_active", True):
+        version = REVOKED_TOKEN_VERSION
+    else:
+        version = user_doc.get("token_version", 0)
+    token_version_cache.set(user_id, version, epoch=epoch)
+    return version
+
+async def revoke_user_tokens(user_id: str):
+    """Invalidate every token issued to user_id so far (role change, deactivation, deletion)"""
+    user_doc = await db.users.find_one_and_update(
+        {"id": user_id},
+        {"$inc": {"token_version": 1}},
+        projection={"token_version": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    token_version_cache.invalidate(user_id)
+    token_version_cache.set(
+        user_id,
+        user_doc["token_version"] if user_doc else REVOKED_TOKEN_VERSION,
+    )
+    user_cache.invalidate(user_id)
+    await db.refresh_tokens.delete_many({"user_id": user_id})
+
+def decode_token(token: str) -> Optional[dict]:
+    """Verified claims of a JWT, memoized until the token expires; None if invalid"""
+    payload = jwt_cache.get(token)
+    if payload is not None:
+        return payload
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        user = await db.users.find_one({"id": user_id})
-        if user is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        return User(**user)
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except jwt.PyJWTError:
+        return None
+    # Never keep a token cached past its own expiry
+    ttl = JWT_CACHE_TTL_SECONDS
+    if "exp" in payload:
+        ttl = min(ttl, payload["exp"] - time.time())
+    if ttl > 0:
+        jwt_cache.set(token, payload, ttl_seconds=ttl)
+    return payload
+
+async def verify_token_claims(token: str) -> Optional[dict]:
+    """Decode a JWT and check its version is still current; None if it is not usable"""
+    payload = decode_token(token)
+    if payload is None:
+        return None
+    user_id = payload.get("sub")
+    if user_id is None:
+        return None
+    # Tokens issued before versioning carry no "tv" and count as version 0
+    if payload.get("tv", 0) != await get_token_version(user_id):
+        return None
+    return payload
+
+async def load_user(user_id: str) -> Optional[User]:
+    """Return the user for user_id, served from the user cache when possible"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    epoch = user_cache.epoch
+    user_doc = await db.users.find_one({"id": user_id})
+    if user_doc is None:
+        return None
+    user = User(**user_doc)
+    user_cache.set(user_id, user, epoch=epoch)
+    return user
+
+async def get_token_claims(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = await verify_token_claims(credentials.credentials)
+    if payload is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    return payload
 
-async def get_admin_user(current_user: User = Depends(get_current_user)):
-    if current_user.role != "admin":
+async def get_current_user(claims: dict = Depends(get_token_claims)):
+    user = await load_user(claims["sub"])
+    if user is None:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Not enough permissions"
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
         )
-    return current_user
-
-async def get_admin_user(current_user: User = Depends(get_current_user)):
-    if current_user.role != "admin":
+    return user
+
+async def get_admin_user(claims: dict = Depends(get_token_claims)) -> Principal:
+    # Authorized from the verified claims alone: admin routes never load the
+    # user. Only tokens issued before the role claim existed need the document.
+    role = claims.get("role")
+    if role is None:
+        user = await load_user(claims["sub"])
+        role = user.role if user else None
+    if role != "admin":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Admin access required"
         )
-    return current_user
-
-async def get_current_user_optional(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
-    if not credentials:
-        return None
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            return None
-        user = await db.users.find_one({"id": user_id})
-        if user is None:
-            return None
-        return User(**user)
-    except (jwt.PyJWTError, Exception):
-        return None
+    return Principal(id=claims["sub"], role=role)
 
 # Database initialization - MANUAL SETUP ONLY
 async def init_db():
@@ -279,10 +793,1911 @@ async def init_db():
     if services_count == 0:
         print("⚠️  No services found. Services must be created manually via admin interface.")
     
+    # Refresh tokens are looked up by hash and purged by Mongo once expired
+    await db.refresh_tokens.create_index("token_hash", unique=True)
+    await db.refresh_tokens.create_index("family_id")
+    await db.refresh_tokens.create_index("user_id")
+    await db.refresh_tokens.create_index("expires_at", expireAfterSeconds=0)
+    
+    # Lets the storage GC check a batch of stored files against orders in one query
+    await db.orders.create_index("files.file_id")
+    
+    # Files of every order, for point lookups and per-client listings
+    # One row per order entry, whichever of the upload and the backfill writes it first
+    await db.order_files.create_index([("order_id", 1), ("file_id", 1), ("uploaded_at", 1)], unique=True)
+    await db.order_files.create_index([("owner_id", 1), ("uploaded_at", -1)])
+    await db.order_files.create_index("file_id")
+    
+    # One stored blob per content digest, shared by every order referencing it
+    await db.blobs.create_index("sha256", unique=True)
+    await db.blobs.create_index("file_id", unique=True)
+    # Startup re-queues files whose analysis never ran
+    await db.blobs.create_index("analysis_state")
+    
+    # Upload sessions are removed by the session GC, which also deletes their staged chunks
+    await db.upload_sessions.create_index("id", unique=True)
+    await db.upload_sessions.create_index("expires_at")
+    
+    # Export manifests are kept just long enough to resume an interrupted download
+    await db.exports.create_index("expires_at", expireAfterSeconds=0)
+    
     users_count = await db.users.count_documents({})
     print(f"🚀 Database status - Services: {services_count}, Users: {users_count}")
     print("📋 All data creation is now manual via UI interface")
 
+# File storage backends
+class StoredFile:
+    """A stored file opened for reading: size and metadata are known, content is read lazily.
+
+    path is set when the content is a plain file on local disk, so downloads
+    can hand it to the server instead of reading it through Python. backend is
+    the storage it was opened from, which delta versions read their base from.
+    """
+
+    def __init__(self, file_id: str, filename: str, length: int, metadata: Optional[dict], path: Optional[Path] = None):
+        self.file_id = file_id
+        self.filename = filename
+        self.length = length
+        self.metadata = metadata or {}
+        self.path = path
+        self.backend = None
+
+    @property
+    def encoding(self) -> str:
+        """How the stored bytes encode the content: identity (as uploaded), zstd,
+        or delta (patches against the file named by metadata.deltaBase)"""
+        return self.metadata.get("contentEncoding", "identity")
+
+    @property
+    def content_length(self) -> int:
+        """Size of the file as uploaded, before any compression"""
+        return self.metadata.get("originalLength", self.length)
+
+    async def iter_range(self, start: int = 0, end: Optional[int] = None):
+        """Yield bytes [start, end] of the file as stored"""
+        raise NotImplementedError
+
+    async def iter_content(self, start: int = 0, end: Optional[int] = None):
+        """Yield bytes [start, end] of the file as uploaded, decoding on the fly"""
+        if self.encoding == "identity":
+            async for chunk in self.iter_range(start, end):
+                yield chunk
+            return
+        decoded = iter_delta_content(self) if self.encoding == "delta" else self._iter_zstd()
+        if start == 0 and end is None:
+            async for chunk in decoded:
+                yield chunk
+            return
+        if end is None:
+            end = self.content_length - 1
+        # Decoding can only start at the beginning: skip up to start
+        async for chunk in iter_slice(decoded, start, end):
+            yield chunk
+
+    async def _iter_zstd(self):
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        async for compressed in self.iter_range():
+            chunk = decompressor.decompress(compressed)
+            if chunk:
+                yield chunk
+
+async def iter_slice(chunks, start: int, end: int):
+    """Yield bytes [start, end] of a stream of chunks"""
+    position = 0
+    async for chunk in chunks:
+        chunk_start = position
+        position += len(chunk)
+        if position <= start:
+            continue
+        yield chunk[max(0, start - chunk_start):end + 1 - chunk_start]
+        if position > end:
+            return
+
+class GridFSStoredFile(StoredFile):
+    def __init__(self, grid_out):
+        super().__init__(str(grid_out._id), grid_out.filename, grid_out.length, grid_out.metadata)
+        self._grid_out = grid_out
+
+    async def iter_range(self, start: int = 0, end: Optional[int] = None):
+        # At most one stored chunk is held at a time
+        grid_out = self._grid_out
+        if end is None:
+            end = self.length - 1
+        whole_file = start == 0 and end == self.length - 1
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            if whole_file:
+                chunk = await grid_out.readchunk()
+            else:
+                chunk = await grid_out.read(min(grid_out.chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+class LocalStoredFile(StoredFile):
+    async def iter_range(self, start: int = 0, end: Optional[int] = None):
+        if end is None:
+            end = self.length - 1
+        handle = await run_in_threadpool(open, self.path, "rb")
+        try:
+            await run_in_threadpool(handle.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await run_in_threadpool(handle.read, min(LOCAL_STORAGE_READ_BYTES, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            handle.close()
+
+class GridFSWriter:
+    def __init__(self, grid_in):
+        self._grid_in = grid_in
+        self.file_id = str(grid_in._id)
+
+    @property
+    def closed(self) -> bool:
+        return self._grid_in.closed
+
+    async def write(self, data: bytes):
+        await self._grid_in.write(data)
+
+    async def close(self, metadata: dict):
+        await self._grid_in.set("metadata", metadata)
+        await self._grid_in.close()
+
+    async def abort(self):
+        if not self._grid_in.closed:
+            await self._grid_in.abort()
+
+class LocalDiskWriter:
+    """Writes to a temporary file next to the final path and renames it into place on close,
+    so a file is either complete or absent"""
+
+    def __init__(self, path: Path, file_id: str, filename: str):
+        self.file_id = file_id
+        self.closed = False
+        self._path = path
+        self._temp_path = path.with_name(f".{file_id}.{secrets.token_hex(4)}.part")
+        self._filename = filename
+        self._handle = None
+        self._length = 0
+
+    def _open(self):
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        return open(self._temp_path, "xb")
+
+    def _finish(self, metadata: dict):
+        if self._handle is None:
+            self._handle = self._open()
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self._handle.close()
+        # The sidecar goes first: a data file without one is never visible
+        with open(self._path.with_suffix(".json"), "w") as sidecar:
+            json.dump({
+                "filename": self._filename,
+                "length": self._length,
+                "uploadDate": datetime.utcnow().isoformat(),
+                "metadata": metadata,
+            }, sidecar)
+        os.replace(self._temp_path, self._path)
+
+    def _discard(self):
+        if self._handle is not None:
+            self._handle.close()
+        self._temp_path.unlink(missing_ok=True)
+
+    async def write(self, data: bytes):
+        if self._handle is None:
+            self._handle = await run_in_threadpool(self._open)
+        await run_in_threadpool(self._handle.write, data)
+        self._length += len(data)
+
+    async def close(self, metadata: dict):
+        await run_in_threadpool(self._finish, metadata)
+        self.closed = True
+
+    async def abort(self):
+        if not self.closed:
+            await run_in_threadpool(self._discard)
+            self.closed = True
+
+class GridFSStorage:
+    """File content in MongoDB GridFS (fs.files / fs.chunks)"""
+
+    name = "gridfs"
+
+    def __init__(self, bucket, files_collection):
+        self.bucket = bucket
+        self.files = files_collection
+
+    def open_writer(self, filename: str, file_id: Optional[str] = None) -> GridFSWriter:
+        if file_id:
+            return GridFSWriter(self.bucket.open_upload_stream_with_id(ObjectId(file_id), filename))
+        return GridFSWriter(self.bucket.open_upload_stream(filename))
+
+    async def open(self, file_id: str) -> StoredFile:
+        """Raises FileNotFoundError for unknown or malformed ids"""
+        try:
+            # Only the fs.files document is read here; chunks are fetched while streaming
+            grid_out = await self.bucket.open_download_stream(ObjectId(file_id))
+        except (InvalidId, NoFile):
+            raise FileNotFoundError(file_id)
+        stored = GridFSStoredFile(grid_out)
+        stored.backend = self
+        return stored
+
+    async def delete(self, file_id: str):
+        try:
+            await self.bucket.delete(ObjectId(file_id))
+        except (InvalidId, NoFile):
+            pass
+
+    async def iter_file_ids(self):
+        async for file_doc in self.files.find({}, {"_id": 1}):
+            yield str(file_doc["_id"])
+
+class LocalDiskStorage:
+    """File content on local disk, one file per id plus a JSON sidecar for its metadata.
+
+    Ids are ObjectId strings like GridFS ones, so order documents stay valid when
+    files are migrated between backends. Files are sharded two levels deep on the
+    last four hex digits, which vary the fastest, to keep directories small.
+    """
+
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path_for(self, file_id: str) -> Path:
+        # Only well-formed ids are ever turned into paths
+        if not ObjectId.is_valid(file_id):
+            raise FileNotFoundError(file_id)
+        file_id = str(ObjectId(file_id))
+        return self.root / file_id[-2:] / file_id[-4:-2] / file_id
+
+    def open_writer(self, filename: str, file_id: Optional[str] = None) -> LocalDiskWriter:
+        file_id = file_id or str(ObjectId())
+        return LocalDiskWriter(self.path_for(file_id), file_id, filename)
+
+    def _load(self, file_id: str) -> StoredFile:
+        path = self.path_for(file_id)
+        length = path.stat().st_size
+        with open(path.with_suffix(".json")) as sidecar:
+            info = json.load(sidecar)
+        return LocalStoredFile(file_id, info.get("filename", file_id), length, info.get("metadata"), path)
+
+    async def open(self, file_id: str) -> StoredFile:
+        """Raises FileNotFoundError for unknown or malformed ids"""
+        stored = await run_in_threadpool(self._load, file_id)
+        stored.backend = self
+        return stored
+
+    def _delete(self, file_id: str):
+        path = self.path_for(file_id)
+        path.unlink(missing_ok=True)
+        path.with_suffix(".json").unlink(missing_ok=True)
+
+    async def delete(self, file_id: str):
+        try:
+            await run_in_threadpool(self._delete, file_id)
+        except FileNotFoundError:
+            pass
+
+    def _list_ids(self) -> List[str]:
+        if not self.root.is_dir():
+            return []
+        return [
+            path.name for path in self.root.glob("*/*/*")
+            if not path.suffix and ObjectId.is_valid(path.name)
+        ]
+
+    async def iter_file_ids(self):
+        for file_id in await run_in_threadpool(self._list_ids):
+            yield file_id
+
+class MemoryStoredFile(StoredFile):
+    def __init__(self, file_id: str, filename: str, metadata: dict, data: bytes):
+        super().__init__(file_id, filename, len(data), metadata)
+        self._data = data
+
+    async def iter_range(self, start: int = 0, end: Optional[int] = None):
+        if end is None:
+            end = self.length - 1
+        for offset in range(start, end + 1, LOCAL_STORAGE_READ_BYTES):
+            yield self._data[offset:min(offset + LOCAL_STORAGE_READ_BYTES, end + 1)]
+
+class TieredFileCache:
+    """Byte-budgeted LRU of stored file bodies with a memory tier and a local-disk tier.
+
+    Entries hold the bytes as stored plus their metadata, so a hit needs no
+    backend round trip at all. Files evicted from memory are demoted to disk,
+    where hits are served like local storage (sendfile included). Each process
+    keeps its disk tier in its own directory, removed on shutdown.
+    """
+
+    def __init__(self, memory_bytes: int, disk_bytes: int, disk_root: Path, max_entry_bytes: int):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.disk_path = disk_root / str(os.getpid())
+        self.max_entry_bytes = max_entry_bytes
+        self._memory = OrderedDict()  # file_id -> (filename, metadata, data)
+        self._disk = OrderedDict()  # file_id -> (filename, metadata, length)
+        self.memory_used = 0
+        self.disk_used = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        self.demotions = 0
+
+    def get(self, file_id: str) -> Optional[StoredFile]:
+        entry = self._memory.get(file_id)
+        if entry is not None:
+            self._memory.move_to_end(file_id)
+            self.memory_hits += 1
+            return MemoryStoredFile(file_id, *entry)
+        entry = self._disk.get(file_id)
+        if entry is not None:
+            self._disk.move_to_end(file_id)
+            self.disk_hits += 1
+            filename, metadata, length = entry
+            return LocalStoredFile(file_id, filename, length, metadata, self.disk_path / file_id)
+        self.misses += 1
+        return None
+
+    def accepts(self, length: int) -> bool:
+        """Whether put would keep an entry of this size in either tier"""
+        return length <= self.max_entry_bytes and (length <= self.memory_bytes or length <= self.disk_bytes)
+
+    async def put(self, stored: StoredFile, data: bytes):
+        if stored.file_id in self._memory or len(data) > self.max_entry_bytes:
+            return
+        if len(data) > self.memory_bytes:
+            await self._put_disk(stored.file_id, stored.filename, stored.metadata, data)
+            return
+        self._memory[stored.file_id] = (stored.filename, stored.metadata, data)
+        self.memory_used += len(data)
+        while self.memory_used > self.memory_bytes:
+            file_id, (filename, metadata, evicted) = self._memory.popitem(last=False)
+            self.memory_used -= len(evicted)
+            self.memory_evictions += 1
+            await self._put_disk(file_id, filename, metadata, evicted)
+
+    def _write_disk(self, file_id: str, data: bytes):
+        self.disk_path.mkdir(parents=True, exist_ok=True)
+        temp_path = self.disk_path / f".{file_id}.{secrets.token_hex(4)}.part"
+        temp_path.write_bytes(data)
+        os.replace(temp_path, self.disk_path / file_id)
+
+    async def _put_disk(self, file_id: str, filename: str, metadata: dict, data: bytes):
+        if file_id in self._disk or len(data) > self.disk_bytes:
+            return
+        await run_in_threadpool(self._write_disk, file_id, data)
+        self._disk[file_id] = (filename, metadata, len(data))
+        self.disk_used += len(data)
+        self.demotions += 1
+        while self.disk_used > self.disk_bytes:
+            evicted_id, (_, _, length) = self._disk.popitem(last=False)
+            self.disk_used -= length
+            self.disk_evictions += 1
+            await run_in_threadpool((self.disk_path / evicted_id).unlink, True)
+
+    async def invalidate(self, file_id: str):
+        entry = self._memory.pop(file_id, None)
+        if entry is not None:
+            self.memory_used -= len(entry[2])
+        entry = self._disk.pop(file_id, None)
+        if entry is not None:
+            self.disk_used -= entry[2]
+            await run_in_threadpool((self.disk_path / file_id).unlink, True)
+
+    def close(self):
+        shutil.rmtree(self.disk_path, ignore_errors=True)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory": {
+                "entries": len(self._memory),
+                "bytes": self.memory_used,
+                "max_bytes": self.memory_bytes,
+                "hits": self.memory_hits,
+                "evictions": self.memory_evictions,
+            },
+            "disk": {
+                "entries": len(self._disk),
+                "bytes": self.disk_used,
+                "max_bytes": self.disk_bytes,
+                "hits": self.disk_hits,
+                "evictions": self.disk_evictions,
+                "demotions": self.demotions,
+            },
+            "misses": self.misses,
+            "hit_ratio": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+class CachingStoredFile(StoredFile):
+    """A backend file that adds itself to the cache once it has been read in full"""
+
+    def __init__(self, inner: StoredFile, cache: TieredFileCache):
+        super().__init__(inner.file_id, inner.filename, inner.length, inner.metadata, inner.path)
+        self._inner = inner
+        self._cache = cache
+
+    async def iter_range(self, start: int = 0, end: Optional[int] = None):
+        if start != 0 or (end is not None and end < self.length - 1) or not self._cache.accepts(self.length):
+            async for chunk in self._inner.iter_range(start, end):
+                yield chunk
+            return
+        data = bytearray()
+        async for chunk in self._inner.iter_range():
+            data += chunk
+            yield chunk
+        if len(data) == self.length:
+            await self._cache.put(self, bytes(data))
+
+class CachedStorage:
+    """Puts a TieredFileCache in front of a storage backend; writes go straight through"""
+
+    def __init__(self, backend, cache: TieredFileCache):
+        self.backend = backend
+        self.cache = cache
+        self.name = backend.name
+
+    def open_writer(self, filename: str, file_id: Optional[str] = None):
+        return self.backend.open_writer(filename, file_id=file_id)
+
+    async def open(self, file_id: str) -> StoredFile:
+        stored = self.cache.get(file_id)
+        if stored is None:
+            stored = CachingStoredFile(await self.backend.open(file_id), self.cache)
+        # Delta bases are looked up through the cache too
+        stored.backend = self
+        return stored
+
+    async def delete(self, file_id: str):
+        await self.cache.invalidate(file_id)
+        await self.backend.delete(file_id)
+
+    def iter_file_ids(self):
+        return self.backend.iter_file_ids()
+
+    async def warm(self, file_id: str):
+        """Read a file once so the next downloads are cache hits"""
+        try:
+            stored = await self.open(file_id)
+            # Rebuilding a delta also caches its base and the rebuilt content
+            delta = stored.encoding == "delta"
+            if not self.cache.accepts(stored.content_length if delta else stored.length):
+                return
+            chunks = stored.iter_content() if delta else stored.iter_range()
+            async for _ in chunks:
+                pass
+        except FileNotFoundError:
+            pass
+
+def get_storage_backend(name: str):
+    if name == GridFSStorage.name:
+        return GridFSStorage(fs, db.fs.files)
+    if name == LocalDiskStorage.name:
+        return LocalDiskStorage(LOCAL_STORAGE_PATH)
+    raise ValueError(f"Unknown file storage backend: {name}")
+
+# Every upload and download goes through this
+file_cache = TieredFileCache(FILE_CACHE_MEMORY_BYTES, FILE_CACHE_DISK_BYTES, FILE_CACHE_DISK_PATH, FILE_CACHE_MAX_ENTRY_BYTES)
+storage = CachedStorage(get_storage_backend(FILE_STORAGE_BACKEND), file_cache)
+
+# File upload helpers
+class MultipartUploadParser:
+    """Feeds a multipart body to python-multipart and records what it sees.
+
+    The parser callbacks are synchronous, so file data is only queued here and
+    written to storage by ingest_upload between two reads of the request body.
+    """
+
+    def __init__(self, boundary: bytes):
+        self.fields = {}
+        self.events = []
+        self._headers = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._field_name = None
+        self._field_data = None
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._field_name = None
+        self._field_data = None
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._field_name = options.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" in options:
+            content_type = self._headers.get(b"content-type", b"application/octet-stream")
+            self.events.append(("file_begin", self._field_name, options[b"filename"].decode("utf-8", "replace"), content_type.decode("latin-1")))
+        else:
+            self._field_data = bytearray()
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._field_data is None:
+            self.events.append(("file_data", data[start:end]))
+            return
+        self._field_data += data[start:end]
+        if len(self._field_data) > MAX_FORM_FIELD_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail="Form field too large"
+            )
+
+    def on_part_end(self):
+        if self._field_data is None:
+            self.events.append(("file_end",))
+        else:
+            self.fields[self._field_name] = self._field_data.decode("utf-8", "replace")
+
+    def write(self, chunk: bytes):
+        self._parser.write(chunk)
+
+    def finalize(self):
+        self._parser.finalize()
+
+class UploadIngest:
+    """Writes one uploaded file into storage, hashing and compressing it on the way.
+
+    The size limit is enforced on the running byte count, so an oversized file
+    is rejected as soon as it crosses the limit. length, sha256 and crc32 always
+    describe the file as uploaded, whatever the stored encoding.
+    """
+
+    def __init__(self, filename: str, content_type: str, max_bytes: int, too_large: HTTPException):
+        self.upload = {"filename": filename, "content_type": content_type, "length": 0, "stored_length": 0}
+        self._max_bytes = max_bytes
+        self._too_large = too_large
+        self._writer = storage.open_writer(filename)
+        self._digest = hashlib.sha256()
+        self._crc32 = 0
+        self._compressor = zstandard.ZstdCompressor(level=FILE_COMPRESSION_LEVEL).compressobj() if FILE_COMPRESSION_ENABLED else None
+
+    async def write(self, chunk: bytes):
+        upload = self.upload
+        upload["length"] += len(chunk)
+        if upload["length"] > self._max_bytes:
+            raise self._too_large
+        self._digest.update(chunk)
+        self._crc32 = zlib.crc32(chunk, self._crc32)
+        data = self._compressor.compress(chunk) if self._compressor else chunk
+        if data:
+            upload["stored_length"] += len(data)
+            await self._writer.write(data)
+
+    async def close(self) -> dict:
+        """Returns the stored file's id, name, size, stored size, encoding, SHA-256 and CRC-32"""
+        upload = self.upload
+        upload["sha256"] = self._digest.hexdigest()
+        upload["crc32"] = self._crc32
+        metadata = {"contentType": upload["content_type"], "sha256": upload["sha256"]}
+        upload["encoding"] = "identity"
+        if self._compressor:
+            tail = self._compressor.flush()
+            upload["stored_length"] += len(tail)
+            await self._writer.write(tail)
+            upload["encoding"] = "zstd"
+            metadata.update({"contentEncoding": "zstd", "originalLength": upload["length"]})
+        await self._writer.close(metadata)
+        upload["file_id"] = self._writer.file_id
+        return upload
+
+    async def abort(self):
+        await self._writer.abort()
+
+def upload_too_large(max_bytes: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"File too large. Maximum size is {max_bytes // (1024 * 1024)}MB"
+    )
+
+async def ingest_upload(request: Request, max_bytes: Optional[int] = None) -> dict:
+    """Stream a multipart upload's "file" part into storage as it arrives.
+
+    Returns what UploadIngest.close does plus the other form fields.
+    """
+    max_bytes = max_bytes or MAX_UPLOAD_BYTES
+    too_large = upload_too_large(max_bytes)
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + MAX_UPLOAD_OVERHEAD_BYTES:
+        raise too_large
+    
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Expected a multipart/form-data upload"
+        )
+    
+    parser = MultipartUploadParser(options[b"boundary"])
+    ingest = None
+    try:
+        async for body_chunk in request.stream():
+            parser.write(body_chunk)
+            for event in parser.events:
+                if event[0] == "file_begin":
+                    if event[1] != "file" or ingest is not None:
+                        raise HTTPException(
+                            status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Only one file can be uploaded per request"
+                        )
+                    ingest = UploadIngest(event[2], event[3], max_bytes, too_large)
+                elif event[0] == "file_data":
+                    await ingest.write(event[1])
+            parser.events.clear()
+        parser.finalize()
+        
+        if ingest is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No file uploaded"
+            )
+        upload = await ingest.close()
+    except BaseException:
+        # Drop whatever was already written for a rejected upload
+        if ingest is not None:
+            await ingest.abort()
+        raise
+    
+    upload["fields"] = parser.fields
+    return upload
+
+# Resumable upload sessions
+def upload_session_status(session: dict) -> UploadSessionStatus:
+    chunk_size = session["chunk_size"]
+    received = sorted(int(index) for index in session.get("chunks", {}))
+    received_set = set(received)
+    return UploadSessionStatus(
+        id=session["id"],
+        order_id=session["order_id"],
+        filename=session["filename"],
+        length=session["length"],
+        chunk_size=chunk_size,
+        chunk_count=session["chunk_count"],
+        received_chunks=received,
+        received_offsets=[index * chunk_size for index in received],
+        received_bytes=sum(chunk["length"] for chunk in session.get("chunks", {}).values()),
+        missing_chunks=[index for index in range(session["chunk_count"]) if index not in received_set],
+        state=session["state"],
+        expires_at=session["expires_at"]
+    )
+
+async def create_upload_session(order: dict, request: UploadSessionCreate, user_id: str, kind: str) -> dict:
+    if request.length <= 0 or request.length > UPLOAD_SESSION_MAX_BYTES:
+        raise upload_too_large(UPLOAD_SESSION_MAX_BYTES)
+    now = datetime.utcnow()
+    session = {
+        "id": str(uuid.uuid4()),
+        "kind": kind,  # client or admin: decides what completing the session does
+        "user_id": user_id,
+        "order_id": order["id"],
+        "filename": request.filename,
+        "notes": request.notes,
+        "version_type": request.version_type,
+        "length": request.length,
+        "sha256": request.sha256.lower() if request.sha256 else None,
+        "chunk_size": UPLOAD_CHUNK_BYTES,
+        "chunk_count": math.ceil(request.length / UPLOAD_CHUNK_BYTES),
+        "chunks": {},
+        "state": "open",
+        "created_at": now,
+        "expires_at": now + timedelta(hours=UPLOAD_SESSION_EXPIRE_HOURS),
+    }
+    await db.upload_sessions.insert_one(session)
+    return session
+
+async def get_upload_session(session_id: str, user: User) -> dict:
+    session = await db.upload_sessions.find_one({"id": session_id, "user_id": user.id})
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Upload session not found or expired"
+        )
+    return session
+
+async def stage_upload_chunk(session: dict, index: int, request: Request) -> dict:
+    """Stream one chunk's body into storage and record it on the session.
+
+    Sending a chunk again replaces it, so a client that lost the response can
+    simply retry. Returns the updated session.
+    """
+    if session["state"] != "open":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload session is already completed"
+        )
+    if index < 0 or index >= session["chunk_count"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Chunk index must be between 0 and {session['chunk_count'] - 1}"
+        )
+    expected = min(session["chunk_size"], session["length"] - index * session["chunk_size"])
+    wrong_size = HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f"Chunk {index} must be exactly {expected} bytes"
+    )
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) != expected:
+        raise wrong_size
+    
+    writer = storage.open_writer(f"{session['id']}.{index}")
+    received = 0
+    try:
+        async for body_chunk in request.stream():
+            if not body_chunk:
+                continue
+            received += len(body_chunk)
+            if received > expected:
+                raise wrong_size
+            await writer.write(body_chunk)
+        if received != expected:
+            raise wrong_size
+        await writer.close({"uploadSession": session["id"], "chunk": index})
+    except BaseException:
+        await writer.abort()
+        raise
+    
+    previous = await db.upload_sessions.find_one_and_update(
+        {"id": session["id"], "state": "open"},
+        {"$set": {
+            f"chunks.{index}": {"file_id": writer.file_id, "length": received},
+            "expires_at": datetime.utcnow() + timedelta(hours=UPLOAD_SESSION_EXPIRE_HOURS),
+        }}
+    )
+    if previous is None:
+        # Completed or discarded while this chunk was in flight
+        await storage.delete(writer.file_id)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload session is already completed"
+        )
+    replaced = previous.get("chunks", {}).get(str(index))
+    if replaced:
+        await storage.delete(replaced["file_id"])
+    return await db.upload_sessions.find_one({"id": session["id"]})
+
+async def assemble_upload_session(session: dict) -> dict:
+    """Stream the staged chunks, in order, into one stored file like a regular upload"""
+    ingest = UploadIngest(
+        session["filename"], "application/octet-stream",
+        UPLOAD_SESSION_MAX_BYTES, upload_too_large(UPLOAD_SESSION_MAX_BYTES)
+    )
+    try:
+        for index in range(session["chunk_count"]):
+            chunk = await storage.backend.open(session["chunks"][str(index)]["file_id"])
+            async for data in chunk.iter_range():
+                await ingest.write(data)
+        return await ingest.close()
+    except BaseException:
+        await ingest.abort()
+        raise
+
+async def discard_upload_session(session: dict):
+    for chunk in session.get("chunks", {}).values():
+        await storage.delete(chunk["file_id"])
+    await db.upload_sessions.delete_one({"id": session["id"]})
+
+def reopen_upload_session(session_id: str):
+    return db.upload_sessions.update_one(
+        {"id": session_id, "state": "finalizing"},
+        {"$set": {"state": "open"}, "$unset": {"finalizing_since": ""}}
+    )
+
+async def collect_upload_sessions() -> int:
+    """Delete expired sessions and their staged chunks; returns how many were removed"""
+    now = datetime.utcnow()
+    stuck = now - timedelta(minutes=UPLOAD_SESSION_FINALIZE_TIMEOUT_MINUTES)
+    async for session in db.upload_sessions.find({"state": "finalizing", "finalizing_since": {"$lt": stuck}}, {"id": 1}):
+        await reopen_upload_session(session["id"])
+    removed = 0
+    async for session in db.upload_sessions.find({"expires_at": {"$lt": now}, "state": {"$ne": "finalizing"}}):
+        await discard_upload_session(session)
+        removed += 1
+    return removed
+
+async def run_upload_session_gc():
+    while True:
+        try:
+            removed = await collect_upload_sessions()
+            if removed:
+                logger.info(f"Removed {removed} abandoned upload sessions")
+        except Exception:
+            logger.exception("Upload session GC failed")
+        await asyncio.sleep(UPLOAD_SESSION_GC_SECONDS)
+
+# Content-addressed storage
+async def register_blob(upload: dict, owner_id: str) -> str:
+    """Deduplicate a freshly stored upload by its digest.
+
+    If the same content is already stored, the new copy is dropped and the
+    existing blob gains a reference; otherwise the upload becomes the blob for
+    its digest. owner_id is the client whose order references the blob; only
+    owners may later attach it by digest alone. Returns the file_id the order
+    should point at.
+    """
+    while True:
+        existing = await db.blobs.find_one_and_update(
+            {"sha256": upload["sha256"]},
+            # referenced_at keeps the storage GC off content about to be attached to an order
+            {"$inc": {"refcount": 1}, "$addToSet": {"owners": owner_id}, "$set": {"referenced_at": datetime.utcnow()}}
+        )
+        if existing:
+            if not await blob_is_stored(existing):
+                # Its content was deleted behind the index's back: this upload replaces it
+                await drop_stale_blob(existing)
+                continue
+            await storage.delete(upload["file_id"])
+            return existing["file_id"]
+        try:
+            await db.blobs.insert_one({
+                "file_id": upload["file_id"],
+                "sha256": upload["sha256"],
+                "crc32": upload["crc32"],
+                "length": upload["length"],
+                "stored_length": upload["stored_length"],
+                "encoding": upload["encoding"],
+                "delta_base": upload.get("delta_base"),
+                "refcount": 1,
+                "owners": [owner_id],
+                "analysis_state": "pending",
+                "created_at": datetime.utcnow(),
+                "referenced_at": datetime.utcnow()
+            })
+            if upload.get("delta_base"):
+                # A delta needs its base for as long as it exists
+                await db.blobs.update_one({"file_id": upload["delta_base"]}, {"$inc": {"refcount": 1}})
+            # Only new content is analyzed: a deduplicated upload already has its results
+            analysis_pipeline.submit(upload["file_id"])
+            return upload["file_id"]
+        except DuplicateKeyError:
+            # The same content was registered concurrently: reference that one
+            continue
+
+async def claim_blob(sha256: str, owner_id: str) -> Optional[str]:
+    """Take a reference to stored content by digest, if owner_id already has access to it"""
+    # Knowing a digest is not proof of having the file, so only content the
+    # client has uploaded or been sent before can be attached this way
+    blob = await db.blobs.find_one_and_update(
+        {"sha256": sha256.lower(), "owners": owner_id},
+        {"$inc": {"refcount": 1}, "$set": {"referenced_at": datetime.utcnow()}}
+    )
+    if blob and not await blob_is_stored(blob):
+        # The client has to send the bytes again, which registers them afresh
+        await drop_stale_blob(blob)
+        return None
+    return blob["file_id"] if blob else None
+
+async def blob_is_stored(blob: dict) -> bool:
+    try:
+        # The cache can still hold content already deleted from the backend
+        await storage.backend.open(blob["file_id"])
+    except FileNotFoundError:
+        return False
+    return True
+
+async def drop_stale_blob(blob: dict):
+    """Forget a blob whose content is gone, so its digest can be stored again"""
+    result = await db.blobs.delete_one({"_id": blob["_id"], "file_id": blob["file_id"]})
+    if result.deleted_count and blob.get("delta_base"):
+        await release_blob(blob["delta_base"])
+
+async def release_blob(file_id: str):
+    """Drop one reference to a blob and delete its content once nothing uses it"""
+    blob = await db.blobs.find_one_and_update(
+        {"file_id": file_id},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob is None or blob["refcount"] > 0:
+        return
+    # Only delete if no new reference was taken in the meantime
+    result = await db.blobs.delete_one({"file_id": file_id, "refcount": {"$lte": 0}})
+    if result.deleted_count:
+        await storage.delete(file_id)
+        if blob.get("delta_base"):
+            await release_blob(blob["delta_base"])
+
+async def release_order_file(file_id: str):
+    """Drop the reference an order entry holds on its file, e.g. when the order is deleted"""
+    if await db.blobs.find_one({"file_id": file_id}, {"_id": 1}):
+        await release_blob(file_id)
+    else:
+        # Stored before deduplication and never indexed: the entry was its only reference
+        await storage.delete(file_id)
+
+async def get_storage_report() -> dict:
+    totals = await db.blobs.aggregate([
+        {"$group": {
+            "_id": None,
+            "blobs": {"$sum": 1},
+            "references": {"$sum": "$refcount"},
+            "stored_bytes": {"$sum": "$length"},
+            "referenced_bytes": {"$sum": {"$multiply": ["$length", "$refcount"]}},
+            # Blobs registered before compression have no stored_length: they are stored as-is
+            "compressed_bytes": {"$sum": {"$ifNull": ["$stored_length", "$length"]}},
+            "compressed_blobs": {"$sum": {"$cond": [{"$eq": ["$encoding", "zstd"]}, 1, 0]}},
+            "delta_blobs": {"$sum": {"$cond": [{"$eq": ["$encoding", "delta"]}, 1, 0]}},
+            "delta_saved_bytes": {"$sum": {"$cond": [
+                {"$eq": ["$encoding", "delta"]}, {"$subtract": ["$length", "$stored_length"]}, 0
+            ]}}
+        }}
+    ]).to_list(1)
+    report = totals[0] if totals else {
+        "blobs": 0, "references": 0, "stored_bytes": 0, "referenced_bytes": 0, "compressed_bytes": 0,
+        "compressed_blobs": 0, "delta_blobs": 0, "delta_saved_bytes": 0
+    }
+    report.pop("_id", None)
+    report["dedup_saved_bytes"] = report["referenced_bytes"] - report["stored_bytes"]
+    report["compression_saved_bytes"] = report["stored_bytes"] - report["compressed_bytes"] - report["delta_saved_bytes"]
+    report["compression"] = "zstd" if FILE_COMPRESSION_ENABLED else "none"
+    report["backend"] = storage.name
+    return report
+
+# Post-upload analysis
+# Analyzers take a file's content and return a small dict, stored under their
+# name in the blob's "analysis" field. They run on a worker thread.
+ANALYZERS = {}
+
+def analyzer(name: str):
+    def register(func):
+        ANALYZERS[name] = func
+        return func
+    return register
+
+@analyzer("digest")
+def analyze_digest(data: bytes) -> dict:
+    # MD5 and SHA-1 are what tuning tools and file databases list files by
+    return {"md5": hashlib.md5(data).hexdigest(), "sha1": hashlib.sha1(data).hexdigest()}
+
+@analyzer("size")
+def analyze_size(data: bytes) -> dict:
+    # Flash and EEPROM dumps come in power-of-two sizes; anything else is usually a partial read
+    length = len(data)
+    return {"length": length, "power_of_two": length > 0 and length & (length - 1) == 0}
+
+def ecu_identifier(pattern: bytes):
+    # Whole identification strings only: short markers alone turn up in random data
+    return re.compile(rb"(?<![A-Za-z0-9])" + pattern + rb"(?![A-Za-z0-9])")
+
+# Identification strings found in the flash of common ECU families, most specific first
+ECU_FAMILY_IDENTIFIERS = [
+    (ecu_identifier(rb"EDC1[5-7][A-Z]{1,2}[0-9]{1,2}"), "Bosch EDC"),  # EDC17C46, EDC16U31
+    (ecu_identifier(rb"MEVD17\.[0-9]{1,2}(?:\.[0-9]{1,2})?"), "Bosch MEVD17"),  # MEVD17.2.9
+    (ecu_identifier(rb"MED17\.[0-9]{1,2}(?:\.[0-9]{1,2})?"), "Bosch MED17"),  # MED17.5.2
+    (ecu_identifier(rb"ME17\.[0-9]{1,2}(?:\.[0-9]{1,2})?"), "Bosch ME17"),  # ME17.9.21
+    (ecu_identifier(rb"MED9\.[0-9](?:\.[0-9])?"), "Bosch MED9"),  # MED9.1
+    (ecu_identifier(rb"ME7\.[0-9](?:\.[0-9])?"), "Bosch ME7"),  # ME7.5
+    (ecu_identifier(rb"MG1[A-Z]{2}[0-9]{3}"), "Bosch MG1"),  # MG1CS001
+    (ecu_identifier(rb"MD1[A-Z]{2}[0-9]{3}"), "Bosch MD1"),  # MD1CS004
+    (ecu_identifier(rb"SIMOS ?[0-9]{1,2}(?:\.[0-9]{1,2})?"), "Continental SIMOS"),  # SIMOS18.1
+    (ecu_identifier(rb"PCR ?2\.1"), "Continental PCR2.1"),
+    (ecu_identifier(rb"SID ?[0-9]{3}"), "Siemens/Continental SID"),  # SID807
+    (ecu_identifier(rb"DCM ?[0-9]\.[0-9]{1,2}[A-Z]?"), "Delphi DCM"),  # DCM6.2A
+    (ecu_identifier(rb"MJD ?[0-9][A-Z0-9]{2,3}"), "Magneti Marelli MJD"),  # MJD 6JF
+    (ecu_identifier(rb"IAW ?[0-9][A-Z0-9]{1,3}"), "Magneti Marelli IAW"),  # IAW 5NF
+    (ecu_identifier(rb"DENSO"), "Denso"),
+]
+# Bosch software numbers start with 1037; VAG part numbers look like 03L906018
+BOSCH_SOFTWARE_NUMBER = ecu_identifier(rb"1037[0-9]{6}")
+VAG_PART_NUMBER = ecu_identifier(rb"0[0-9][0-9A-Z]9(?:06|07)[0-9]{3}[A-Z]{0,2}")
+# Printable runs that can hold an identifier; one pass over the flash, the patterns only see these
+IDENTIFICATION_RUN = re.compile(rb"[0-9A-Z][0-9A-Z .]{4,}")
+
+@analyzer("ecu")
+def analyze_ecu(data: bytes) -> dict:
+    """Identification found in the file; None rather than a guess when there is none"""
+    strings = b"\n".join(IDENTIFICATION_RUN.findall(data))
+    family = identifier = None
+    for pattern, name in ECU_FAMILY_IDENTIFIERS:
+        match = pattern.search(strings)
+        if match:
+            family, identifier = name, match.group().decode()
+            break
+    software = BOSCH_SOFTWARE_NUMBER.search(strings)
+    part = VAG_PART_NUMBER.search(strings)
+    return {
+        "family": family,
+        "identifier": identifier,
+        "software_number": software.group().decode() if software else None,
+        "part_number": part.group().decode() if part else None,
+    }
+
+class AnalyzerTimings:
+    """Run count, failures and duration per analyzer"""
+
+    def __init__(self):
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, failed: bool):
+        with self._lock:
+            self._record(name, seconds, failed)
+
+    def _record(self, name: str, seconds: float, failed: bool):
+        timing = self._timings.setdefault(name, {"runs": 0, "failures": 0, "total_ms": 0.0, "max_ms": 0.0})
+        timing["runs"] += 1
+        timing["failures"] += int(failed)
+        timing["total_ms"] += seconds * 1000
+        timing["max_ms"] = max(timing["max_ms"], seconds * 1000)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "runs": timing["runs"],
+                "failures": timing["failures"],
+                "avg_ms": round(timing["total_ms"] / timing["runs"], 2),
+                "max_ms": round(timing["max_ms"], 2),
+                "total_ms": round(timing["total_ms"], 2),
+            }
+            for name, timing in self._timings.items()
+        }
+
+def run_analyzers(data: bytes, timings: AnalyzerTimings) -> dict:
+    results = {}
+    for name, func in ANALYZERS.items():
+        started = time.perf_counter()
+        try:
+            results[name] = func(data)
+            failed = False
+        except Exception as e:
+            # One broken analyzer must not cost the others their results
+            results[name] = {"error": str(e)}
+            failed = True
+        timings.record(name, time.perf_counter() - started, failed)
+    return results
+
+class AnalysisPipeline:
+    """Bounded queue of file ids drained by a fixed number of worker tasks.
+
+    submit never waits: when the queue is full the file stays "pending" and is
+    queued again at the next startup.
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timings = AnalyzerTimings()
+        self._queue = None
+        self._tasks = []
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def submit(self, file_id: str) -> bool:
+        if self._queue is None:
+            # Not started (maintenance scripts): picked up by the server's next startup
+            return False
+        try:
+            self._queue.put_nowait(file_id)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.queued += 1
+        return True
+
+    async def _work(self):
+        while True:
+            file_id = await self._queue.get()
+            try:
+                await self.analyze(file_id)
+                self.completed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Analysis of {file_id} failed")
+            finally:
+                self._queue.task_done()
+
+    async def analyze(self, file_id: str):
+        try:
+            stored = await storage.open(file_id)
+        except FileNotFoundError:
+            # Released before its turn came
+            return
+        data = bytearray()
+        async for chunk in stored.iter_content():
+            data += chunk[:ANALYSIS_MAX_BYTES - len(data)]
+            if len(data) >= ANALYSIS_MAX_BYTES:
+                break
+        results = await run_in_threadpool(run_analyzers, bytes(data), self.timings)
+        await db.blobs.update_one(
+            {"file_id": file_id},
+            {"$set": {
+                "analysis": results,
+                "analysis_state": "done",
+                "analysis_truncated": stored.content_length > len(data),
+                "analyzed_at": datetime.utcnow(),
+            }}
+        )
+
+    async def requeue_pending(self) -> int:
+        count = 0
+        async for blob in db.blobs.find({"analysis_state": "pending"}, {"file_id": 1}).limit(self.queue_size):
+            count += self.submit(blob["file_id"])
+        return count
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "queued": self.queued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "analyzers": self.timings.stats(),
+        }
+
+analysis_pipeline = AnalysisPipeline(ANALYSIS_WORKERS, ANALYSIS_QUEUE_SIZE)
+
+# Version deltas
+DELTA_MAGIC = b"DMRD\x01"
+DELTA_HEADER = struct.Struct(">QI")  # content length, patch count
+DELTA_PATCH = struct.Struct(">QI")  # offset, size
+
+# Rebuilt delta versions keyed by file id; content never changes for an id
+delta_cache = LRUCache(DELTA_CACHE_MAX_ENTRIES, DELTA_CACHE_TTL_SECONDS)
+
+def encode_delta(length: int, patches: List[tuple]) -> bytes:
+    """Serialize sorted, non-overlapping (offset, bytes) patches for a file of the given length"""
+    parts = [DELTA_MAGIC, DELTA_HEADER.pack(length, len(patches))]
+    parts += [DELTA_PATCH.pack(offset, len(data)) for offset, data in patches]
+    parts += [bytes(data) for _, data in patches]
+    return b"".join(parts)
+
+def decode_delta(delta: bytes) -> tuple:
+    """Inverse of encode_delta: returns (length, patches), the patches being views into delta"""
+    if not delta.startswith(DELTA_MAGIC):
+        raise ValueError("Not a version delta")
+    view = memoryview(delta)
+    position = len(DELTA_MAGIC)
+    length, count = DELTA_HEADER.unpack_from(delta, position)
+    position += DELTA_HEADER.size
+    table = [DELTA_PATCH.unpack_from(delta, position + i * DELTA_PATCH.size) for i in range(count)]
+    position += count * DELTA_PATCH.size
+    patches = []
+    for offset, size in table:
+        patches.append((offset, view[position:position + size]))
+        position += size
+    return length, patches
+
+async def iter_blocks(chunks, size: int):
+    """Re-cut a stream of chunks into blocks of exactly size bytes (the last may be shorter)"""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+async def compute_delta(base: StoredFile, target: StoredFile, max_patch_bytes: int) -> Optional[bytes]:
+    """Patches turning base into target, compared block by block while both stream.
+
+    Tuned versions keep the layout of the original and only change map data in
+    place, so fixed-offset blocks catch exactly what changed. Returns None as
+    soon as the patches would exceed max_patch_bytes.
+    """
+    base_blocks = iter_blocks(base.iter_content(), DELTA_BLOCK_BYTES)
+    patches = []
+    patched = 0
+    offset = 0
+    async for block in iter_blocks(target.iter_content(), DELTA_BLOCK_BYTES):
+        if block != await anext(base_blocks, None):
+            if patches and patches[-1][0] + len(patches[-1][1]) == offset:
+                patches[-1][1].extend(block)
+            else:
+                patches.append((offset, bytearray(block)))
+            patched += len(block)
+            if patched > max_patch_bytes:
+                return None
+        offset += len(block)
+    return encode_delta(offset, patches)
+
+async def iter_patched(base_chunks, length: int, patches: List[tuple]):
+    """Stream the base with the patches applied, cut or extended to length"""
+    index = 0
+    position = 0
+    async for chunk in base_chunks:
+        if position >= length:
+            break
+        chunk = bytearray(chunk[:length - position])
+        chunk_end = position + len(chunk)
+        while index < len(patches) and patches[index][0] < chunk_end:
+            offset, data = patches[index]
+            low, high = max(offset, position), min(offset + len(data), chunk_end)
+            if low < high:
+                chunk[low - position:high - position] = data[low - offset:high - offset]
+            if offset + len(data) > chunk_end:
+                break  # continues into the next chunk
+            index += 1
+        position = chunk_end
+        yield bytes(chunk)
+    # Past the end of the base everything comes from the patches
+    for offset, data in patches[index:]:
+        if offset + len(data) > position:
+            yield bytes(data[max(0, position - offset):])
+            position = offset + len(data)
+
+async def iter_delta_content(stored: StoredFile):
+    """Rebuild a delta version from its base, keeping the result for the next reader"""
+    cached = delta_cache.get(stored.file_id)
+    if cached is not None:
+        yield cached
+        return
+    epoch = delta_cache.epoch
+    delta = b"".join([chunk async for chunk in stored.iter_range()])
+    length, patches = decode_delta(delta)
+    base = await stored.backend.open(stored.metadata["deltaBase"])
+    # Large versions are rebuilt on every read rather than held in memory
+    rebuilt = bytearray() if length <= FILE_CACHE_MAX_ENTRY_BYTES else None
+    async for chunk in iter_patched(base.iter_content(), length, patches):
+        if rebuilt is not None:
+            rebuilt += chunk
+        yield chunk
+    if rebuilt is not None:
+        delta_cache.set(stored.file_id, bytes(rebuilt), epoch=epoch)
+
+async def store_as_delta(upload: dict, base_file_id: str) -> bool:
+    """Replace a freshly stored upload by patches against base_file_id when that is smaller.
+
+    Only full files are used as bases, so rebuilding never chains. On success
+    the upload dict describes the delta file instead.
+    """
+    try:
+        base = await storage.open(base_file_id)
+        target = await storage.open(upload["file_id"])
+    except FileNotFoundError:
+        return False
+    if base.encoding == "delta":
+        return False
+    delta = await compute_delta(base, target, min(int(upload["length"] * DELTA_MAX_RATIO), DELTA_MAX_PATCH_BYTES))
+    if delta is None or len(delta) >= upload["stored_length"]:
+        return False
+    
+    writer = storage.open_writer(upload["filename"])
+    try:
+        await writer.write(delta)
+        await writer.close({
+            "contentType": upload["content_type"],
+            "sha256": upload["sha256"],
+            "contentEncoding": "delta",
+            "deltaBase": base_file_id,
+            "originalLength": upload["length"],
+        })
+    except BaseException:
+        await writer.abort()
+        raise
+    await storage.delete(upload["file_id"])
+    upload.update({
+        "file_id": writer.file_id,
+        "stored_length": len(delta),
+        "encoding": "delta",
+        "delta_base": base_file_id,
+    })
+    return True
+
+# File download helpers
+def sign_download(order_id: str, file_id: str, filename: str, expires: int) -> str:
+    message = f"{order_id}\n{file_id}\n{filename}\n{expires}".encode('utf-8')
+    return hmac.new(DOWNLOAD_URL_KEY, message, hashlib.sha256).hexdigest()
+
+def create_download_link(order_id: str, file_id: str, filename: str) -> dict:
+    """Short-lived URL that downloads one file of one order without a session token"""
+    expires = int(time.time()) + DOWNLOAD_URL_EXPIRE_SECONDS
+    signature = sign_download(order_id, file_id, filename, expires)
+    query = urlencode({"filename": filename, "expires": expires, "signature": signature})
+    return {
+        "url": f"/api/files/{order_id}/{file_id}?{query}",
+        "expires_at": datetime.utcfromtimestamp(expires),
+    }
+
+def find_order_file(order: dict, file_id: str) -> Optional[dict]:
+    for file_info in order.get("files", []):
+        if file_info.get("file_id") == file_id:
+            return file_info
+    return None
+
+def order_file_key(order_file: dict) -> dict:
+    """Identifies the order entry an order_files row mirrors"""
+    return {"order_id": order_file["order_id"], "file_id": order_file["file_id"], "uploaded_at": order_file["uploaded_at"]}
+
+async def record_order_file(order_id: str, owner_id: str, file_version: FileVersion):
+    """Index a file version just pushed onto an order"""
+    blob = await db.blobs.find_one({"file_id": file_version.file_id}, {"length": 1, "sha256": 1})
+    order_file = OrderFile(
+        order_id=order_id,
+        owner_id=owner_id,
+        length=blob["length"] if blob else None,
+        sha256=blob["sha256"] if blob else None,
+        **file_version.dict()
+    )
+    order_file = order_file.dict()
+    await db.order_files.replace_one(order_file_key(order_file), order_file, upsert=True)
+
+async def get_order_file(order_id: str, file_id: str, owner_id: Optional[str] = None) -> Optional[dict]:
+    """The order's entry for file_id, restricted to owner_id's orders when given"""
+    query = {"order_id": order_id, "file_id": file_id}
+    if owner_id:
+        query["owner_id"] = owner_id
+    file_info = await db.order_files.find_one(query)
+    if file_info:
+        return file_info
+    # Files attached before the index existed, until backfill_order_files.py has run
+    order_query = {"id": order_id}
+    if owner_id:
+        order_query["user_id"] = owner_id
+    order = await db.orders.find_one(order_query, {"files": 1})
+    return find_order_file(order, file_id) if order else None
+
+def file_etag(stored: StoredFile, encoding: str = "identity") -> str:
+    """Strong validator: the stored SHA-256, or the immutable id for files stored without one.
+
+    Each content-coding is a different representation, so it gets its own tag.
+    """
+    digest = stored.metadata.get("sha256")
+    tag = digest if digest else f"{stored.file_id}-{stored.length}"
+    return f'"{tag}"' if encoding == "identity" else f'"{tag}-{encoding}"'
+
+def accepts_encoding(header: Optional[str], encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows the given content-coding"""
+    if not header:
+        return False
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        if coding.strip().lower() not in (encoding, "*"):
+            continue
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so ignore any W/ prefix
+    candidates = [value.strip() for value in header.split(",")]
+    return any(value.removeprefix("W/") == etag for value in candidates)
+
+def parse_range_header(header: Optional[str], length: int) -> Optional[List[tuple]]:
+    """Byte ranges requested by a Range header as inclusive (start, end) pairs.
+
+    Returns None when the header is absent or malformed (serve the full body),
+    and an empty list when no range can be satisfied (416).
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    ranges = []
+    specs = header[len("bytes="):].split(",")
+    if len(specs) > MAX_BYTE_RANGES:
+        return None
+    for spec in specs:
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else length - 1
+                if last and end < start:
+                    return None
+            else:
+                # Suffix range: the last N bytes
+                suffix = int(last)
+                if suffix == 0:
+                    continue
+                start = max(0, length - suffix)
+                end = length - 1
+        except ValueError:
+            return None
+        if start >= length:
+            continue
+        ranges.append((start, min(end, length - 1)))
+    return ranges
+
+async def iter_byteranges(read, ranges: List[tuple], boundary: str, part_headers: List[bytes]):
+    for (start, end), part_header in zip(ranges, part_headers):
+        yield part_header
+        async for chunk in read(start, end):
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+async def build_file_response(request: Request, file_id: str, filename: str):
+    try:
+        stored = await storage.open(file_id)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
+        )
+    
+    # Compressed files go out as stored to clients that can decode them, and
+    # are decompressed while streaming for everyone else
+    send_encoded = stored.encoding == "zstd" and accepts_encoding(request.headers.get("accept-encoding"), stored.encoding)
+    as_stored = send_encoded or stored.encoding == "identity"
+    if as_stored:
+        length = stored.length
+        read = stored.iter_range
+        etag = file_etag(stored, stored.encoding)
+    else:
+        if stored.encoding == "zstd" and zstandard is None:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="zstandard is required to decompress this file"
+            )
+        length = stored.content_length
+        read = stored.iter_content
+        etag = file_etag(stored)
+    headers = {
+        "Content-Disposition": f"attachment; filename={filename}",
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": FILE_CACHE_CONTROL,
+        "Access-Control-Allow-Origin": "https://engine-tune-portal.emergent.host",
+        "Access-Control-Allow-Credentials": "true",
+        "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+        "Access-Control-Allow-Headers": "*"
+    }
+    if stored.encoding == "zstd":
+        headers["Vary"] = "Accept-Encoding"
+    if send_encoded:
+        headers["Content-Encoding"] = stored.encoding
+    
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    # A stale If-Range validator means the client's partial copy is unusable: send it all
+    ranges = None
+    if_range = request.headers.get("if-range")
+    if not if_range or if_range.strip() == etag:
+        ranges = parse_range_header(request.headers.get("range"), length)
+    
+    if ranges is not None and not ranges:
+        headers["Content-Range"] = f"bytes */{length}"
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+    
+    is_head = request.method == "HEAD"
+    if not ranges:
+        headers["Content-Length"] = str(length)
+        if is_head:
+            return Response(media_type="application/octet-stream", headers=headers)
+        if stored.path and as_stored:
+            # Plain file on disk: Starlette sends it with zero-copy sendfile when
+            # the server offers it, and in a worker thread otherwise
+            return FileResponse(stored.path, media_type="application/octet-stream", headers=headers)
+        return StreamingResponse(read(), media_type="application/octet-stream", headers=headers)
+    
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+        headers["Content-Length"] = str(end - start + 1)
+        if is_head:
+            return Response(status_code=status.HTTP_206_PARTIAL_CONTENT, media_type="application/octet-stream", headers=headers)
+        return StreamingResponse(
+            read(start, end),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type="application/octet-stream",
+            headers=headers
+        )
+    
+    boundary = secrets.token_hex(16)
+    part_headers = [
+        (
+            f"--{boundary}\r\n"
+            f"Content-Type: application/octet-stream\r\n"
+            f"Content-Range: bytes {start}-{end}/{length}\r\n\r\n"
+        ).encode()
+        for start, end in ranges
+    ]
+    body_length = sum(len(part) + (end - start + 1) + 2 for part, (start, end) in zip(part_headers, ranges))
+    body_length += len(f"--{boundary}--\r\n")
+    headers["Content-Length"] = str(body_length)
+    media_type = f"multipart/byteranges; boundary={boundary}"
+    if is_head:
+        return Response(status_code=status.HTTP_206_PARTIAL_CONTENT, media_type=media_type, headers=headers)
+    return StreamingResponse(
+        iter_byteranges(read, ranges, boundary, part_headers),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=headers
+    )
+
+class ZipStreamSink:
+    """Write-only, unseekable target for zipfile that holds output until the response takes it.
+
+    Without seek, zipfile writes each entry's sizes and CRC in a data descriptor
+    after its data, so entries can be written while their content streams in.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def select_order_files(order: dict, file_ids: Optional[List[str]]) -> List[dict]:
+    """The order's files entries to archive: the requested ones, or all of them"""
+    files = order.get("files", [])
+    if not file_ids:
+        return files
+    selected = []
+    for file_id in dict.fromkeys(file_ids):
+        file_info = find_order_file(order, file_id)
+        if not file_info:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="File not found"
+            )
+        selected.append(file_info)
+    return selected
+
+def archive_path_part(value: Optional[str], default: str) -> str:
+    """A single archive path component: no separators, no leading dots"""
+    return (value or "").replace("\\", "_").replace("/", "_").lstrip(".") or default
+
+def archive_entry_name(file_info: dict, used: set, folder: str = "") -> str:
+    """One folder per version type, without path tricks or duplicate names"""
+    filename = archive_path_part(file_info.get("filename"), "file.bin")
+    name = f"{folder}{archive_path_part(file_info.get('version_type'), 'file')}/{filename}"
+    stem, dot, extension = name.rpartition(".")
+    if not dot or "/" in extension:
+        stem, dot, extension = name, "", ""
+    counter = 2
+    while name in used:
+        name = f"{stem} ({counter}){dot}{extension}"
+        counter += 1
+    used.add(name)
+    return name
+
+async def iter_zip(entries: List[tuple]):
+    """Stream a ZIP of (name, uploaded_at, stored file) entries, one storage chunk at a time"""
+    sink = ZipStreamSink()
+    # Stored, not deflated: deflating would spend event-loop time on every
+    # byte of every archive
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as archive:
+        for name, uploaded_at, stored in entries:
+            info = zipfile.ZipInfo(name, date_time=uploaded_at.timetuple()[:6])
+            info.file_size = stored.content_length
+            with archive.open(info, "w") as entry:
+                async for chunk in stored.iter_content():
+                    entry.write(chunk)
+                    data = sink.take()
+                    if data:
+                        yield data
+            yield sink.take()
+    yield sink.take()
+
+async def build_zip_response(order: dict, files: List[dict]):
+    # Open everything first so a missing file is a 404, not a truncated archive
+    entries = []
+    used = set()
+    for file_info in files:
+        try:
+            stored = await storage.open(file_info["file_id"])
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="File not found"
+            )
+        uploaded_at = file_info.get("uploaded_at") or datetime.utcnow()
+        entries.append((archive_entry_name(file_info, used), max(uploaded_at, datetime(1980, 1, 1)), stored))
+    
+    archive_name = order.get("order_number") or order["id"]
+    return StreamingResponse(
+        iter_zip(entries),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={archive_name}.zip"}
+    )
+
+# Bulk exports
+ZIP64_LIMIT = 0xFFFFFFFF
+
+def zip_dos_datetime(value: datetime) -> tuple:
+    value = max(value, datetime(1980, 1, 1))
+    dos_time = (value.hour << 11) | (value.minute << 5) | (value.second // 2)
+    dos_date = ((value.year - 1980) << 9) | (value.month << 5) | value.day
+    return dos_time, dos_date
+
+def build_zip_layout(entries: List[dict]) -> tuple:
+    """Byte layout of a STORED ZIP of entries whose length and CRC-32 are known up front.
+
+    Returns (segments, size), each segment being (offset, length, part) where
+    part is header bytes or the entry whose content fills it. The layout only
+    depends on the entries, so any byte range of the archive can be produced
+    again later without reading the files before it.
+    """
+    segments = []
+    central = []
+    offset = 0
+    for entry in entries:
+        name = entry["name"].encode("utf-8")
+        length = entry["length"]
+        dos_time, dos_date = zip_dos_datetime(entry["uploaded_at"])
+        large = length >= ZIP64_LIMIT
+        size_field = ZIP64_LIMIT if large else length
+        extra = struct.pack("<HHQQ", 1, 16, length, length) if large else b""
+        header = struct.pack(
+            "<IHHHHHIIIHH", 0x04034B50, 45 if large else 20, 0x0800, 0, dos_time, dos_date,
+            entry["crc32"], size_field, size_field, len(name), len(extra)
+        ) + name + extra
+        segments.append((offset, len(header), header))
+        segments.append((offset + len(header), length, entry))
+        
+        zip64_values = [length, length] if large else []
+        if offset >= ZIP64_LIMIT:
+            zip64_values.append(offset)
+        central_extra = struct.pack(f"<HH{len(zip64_values)}Q", 1, 8 * len(zip64_values), *zip64_values) if zip64_values else b""
+        central.append(struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014B50, 45, 45 if zip64_values else 20, 0x0800, 0, dos_time, dos_date,
+            entry["crc32"], size_field, size_field, len(name), len(central_extra), 0, 0, 0, 0, min(offset, ZIP64_LIMIT)
+        ) + name + central_extra)
+        offset += len(header) + length
+    
+    directory = b"".join(central)
+    count = len(entries)
+    end = b""
+    if count >= 0xFFFF or offset >= ZIP64_LIMIT or len(directory) >= ZIP64_LIMIT:
+        end += struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, count, count, len(directory), offset)
+        end += struct.pack("<IIQI", 0x07064B50, 0, offset + len(directory), 1)
+    end += struct.pack(
+        "<IHHHHIIH", 0x06054B50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+        min(len(directory), ZIP64_LIMIT), min(offset, ZIP64_LIMIT), 0
+    )
+    tail = directory + end
+    segments.append((offset, len(tail), tail))
+    return segments, offset + len(tail)
+
+async def iter_export_piece(entry: dict, start: int, end: int):
+    # Straight from the backend: a bulk export would only flush the hot-file cache
+    stored = await storage.backend.open(entry["file_id"])
+    received = 0
+    async for chunk in stored.iter_content(start, end):
+        received += len(chunk)
+        yield chunk
+    if received != end - start + 1:
+        raise IOError(f"File {entry['file_id']} no longer matches the export manifest")
+
+async def read_export_piece(entry: dict, start: int, end: int) -> bytes:
+    return b"".join([chunk async for chunk in iter_export_piece(entry, start, end)])
+
+async def iter_zip_layout(segments: List[tuple], start: int, end: int):
+    """Yield bytes [start, end] of a laid-out archive.
+
+    Files that fit in EXPORT_PREFETCH_BYTES are read ahead of the writer, at most
+    EXPORT_READ_CONCURRENCY at a time and EXPORT_PREFETCH_BYTES in total, and
+    written out in order. Larger files are streamed chunk by chunk when their
+    turn comes, so memory stays bounded whatever the file sizes.
+    """
+    pieces = []
+    for offset, length, part in segments:
+        low, high = max(start, offset), min(end, offset + length - 1)
+        if low <= high:
+            pieces.append((part, low - offset, high - offset))
+    
+    tasks = {}
+    launched = 0
+    in_flight_bytes = 0
+    
+    def read_ahead():
+        nonlocal launched, in_flight_bytes
+        while launched < len(pieces) and len(tasks) < EXPORT_READ_CONCURRENCY:
+            part, low, high = pieces[launched]
+            size = high - low + 1
+            if not isinstance(part, bytes) and size <= EXPORT_PREFETCH_BYTES:
+                if in_flight_bytes + size > EXPORT_PREFETCH_BYTES:
+                    return
+                tasks[launched] = asyncio.create_task(read_export_piece(part, low, high))
+                in_flight_bytes += size
+            launched += 1
+    
+    try:
+        for index, (part, low, high) in enumerate(pieces):
+            read_ahead()
+            if isinstance(part, bytes):
+                yield part[low:high + 1]
+            elif index in tasks:
+                data = await tasks.pop(index)
+                in_flight_bytes -= len(data)
+                yield data
+            else:
+                # Too large to hold: later files keep being read ahead meanwhile
+                async for chunk in iter_export_piece(part, low, high):
+                    yield chunk
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+def export_file_matches(file_info: dict, filters: ExportFilter) -> bool:
+    uploaded_at = file_info.get("uploaded_at")
+    if filters.uploaded_from and (not uploaded_at or uploaded_at < filters.uploaded_from):
+        return False
+    if filters.uploaded_to and (not uploaded_at or uploaded_at >= filters.uploaded_to):
+        return False
+    if filters.version_types and file_info.get("version_type") not in filters.version_types:
+        return False
+    return True
+
+async def measure_file(file_id: str) -> tuple:
+    """Length and CRC-32 of a file's content, read once from storage"""
+    stored = await storage.backend.open(file_id)
+    crc32 = 0
+    length = 0
+    async for chunk in stored.iter_content():
+        crc32 = zlib.crc32(chunk, crc32)
+        length += len(chunk)
+    return length, crc32
+
+async def create_export(filters: ExportFilter, admin_user: Principal) -> dict:
+    """Freeze the files matching filters into a manifest that archives are built from"""
+    query = {}
+    if filters.status:
+        query["status"] = filters.status
+    if filters.user_id:
+        query["user_id"] = filters.user_id
+    file_query = {}
+    if filters.uploaded_from or filters.uploaded_to:
+        file_query["uploaded_at"] = {}
+        if filters.uploaded_from:
+            file_query["uploaded_at"]["$gte"] = filters.uploaded_from
+        if filters.uploaded_to:
+            file_query["uploaded_at"]["$lt"] = filters.uploaded_to
+    if filters.version_types:
+        file_query["version_type"] = {"$in": filters.version_types}
+    query["files"] = {"$elemMatch": file_query} if file_query else {"$exists": True, "$ne": []}
+    
+    entries = []
+    orders = 0
+    cursor = db.orders.find(query, {"_id": 0, "id": 1, "order_number": 1, "files": 1}).sort("created_at", 1)
+    async for order in cursor:
+        folder = archive_path_part(order.get("order_number"), order["id"]) + "/"
+        used = set()
+        matched = [file_info for file_info in order.get("files", []) if export_file_matches(file_info, filters)]
+        orders += 1 if matched else 0
+        for file_info in matched:
+            entries.append({
+                "name": archive_entry_name(file_info, used, folder),
+                "file_id": file_info["file_id"],
+                "uploaded_at": file_info.get("uploaded_at") or datetime.utcnow(),
+            })
+        if len(entries) > EXPORT_MAX_FILES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"More than {EXPORT_MAX_FILES} files match, narrow the filter"
+            )
+    
+    # Lengths and CRC-32s come from the blob registry, so the archive layout is
+    # known without reading any file; older blobs are measured once and backfilled
+    file_ids = list({entry["file_id"] for entry in entries})
+    sizes = {}
+    async for blob in db.blobs.find({"file_id": {"$in": file_ids}}, {"file_id": 1, "length": 1, "crc32": 1}):
+        if blob.get("crc32") is not None:
+            sizes[blob["file_id"]] = (blob["length"], blob["crc32"])
+    for file_id in file_ids:
+        if file_id in sizes:
+            continue
+        try:
+            sizes[file_id] = await measure_file(file_id)
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"File {file_id} is missing from storage"
+            )
+        await db.blobs.update_one({"file_id": file_id}, {"$set": {"crc32": sizes[file_id][1]}})
+    for entry in entries:
+        entry["length"], entry["crc32"] = sizes[entry["file_id"]]
+    
+    _, size = build_zip_layout(entries)
+    now = datetime.utcnow()
+    export = {
+        "id": str(uuid.uuid4()),
+        "filter": filters.dict(),
+        "created_by": admin_user.id,
+        "created_at": now,
+        "expires_at": now + timedelta(hours=EXPORT_EXPIRE_HOURS),
+        "orders": orders,
+        "entries": entries,
+        "size": size,
+    }
+    await db.exports.insert_one(export)
+    return export
+
+def build_export_response(request: Request, export: dict):
+    segments, size = build_zip_layout(export["entries"])
+    etag = f'"export-{export["id"]}"'
+    headers = {
+        "Content-Disposition": f"attachment; filename=export-{export['created_at'].strftime('%Y%m%d-%H%M%S')}.zip",
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+    }
+    
+    # Only single ranges are served: that is all a resuming client asks for
+    ranges = None
+    if_range = request.headers.get("if-range")
+    if not if_range or if_range.strip() == etag:
+        ranges = parse_range_header(request.headers.get("range"), size)
+    if ranges is not None and not ranges:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+    
+    start, end = 0, size - 1
+    status_code = status.HTTP_200_OK
+    if ranges and len(ranges) == 1:
+        start, end = ranges[0]
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, media_type="application/zip", headers=headers)
+    return StreamingResponse(
+        iter_zip_layout(segments, start, end),
+        status_code=status_code,
+        media_type="application/zip",
+        headers=headers
+    )
+
 # Routes
 @api_router.post("/auth/register", response_model=User)
 async def register(user: UserCreate):
@@ -296,7 +2711,7 @@ async def register(user: UserCreate):
     
     # Create new user
     user_dict = user.dict()
-    user_dict["password"] = hash_password(user.password)
+    user_dict["password"] = await hash_password_async(user.password)
     new_user = User(**user_dict)
     # Store user with password in database
     user_db_dict = new_user.dict()
@@ -306,10 +2721,13 @@ async def register(user: UserCreate):
     return new_user
 
 @api_router.post("/auth/login", response_model=Token)
-async def login(user: UserLogin):
+async def login(user: UserLogin, request: Request):
+    # Throttle per IP and per account before touching the database
+    check_login_rate(request, user.email)
+    
     # Find user
     db_user = await db.users.find_one({"email": user.email})
-    if not db_user or not verify_password(user.password, db_user["password"]):
+    if not db_user or not await verify_password_async(user.password, db_user["password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -324,13 +2742,69 @@ async def login(user: UserLogin):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # Move hashes made with another cost to the configured one while we
+    # have the plain password; a busy bcrypt pool just postpones it
+    if get_hash_rounds(db_user["password"]) != BCRYPT_ROUNDS:
+        try:
+            new_hash = await hash_password_async(user.password)
+            await db.users.update_one(
+                {"id": db_user["id"], "password": db_user["password"]},
+                {"$set": {"password": new_hash}}
+            )
+        except HTTPException:
+            pass
+    
+    # Prime the caches so the first authenticated requests skip Mongo
+    token_version_cache.set(db_user["id"], db_user.get("token_version", 0))
+    user_cache.set(db_user["id"], User(**db_user))
+    
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": db_user["id"]}, expires_delta=access_token_expires
+    access_token = create_user_token(db_user, expires_delta=access_token_expires)
+    refresh_token = await issue_refresh_token(
+        db_user["id"], db_user.get("role", "client"), db_user.get("token_version", 0)
     )
     
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+@api_router.post("/auth/refresh", response_model=Token)
+async def refresh_access_token(body: RefreshRequest):
+    token_hash = hash_refresh_token(body.refresh_token)
+    now = datetime.utcnow()
+    
+    # Consume the refresh token; rotation means each one is accepted only once
+    stored = await db.refresh_tokens.find_one_and_update(
+        {"token_hash": token_hash, "used_at": None, "expires_at": {"$gt": now}},
+        {"$set": {"used_at": now}}
+    )
+    if not stored:
+        # A token that was already rotated is being replayed: revoke its family
+        replayed = await db.refresh_tokens.find_one({"token_hash": token_hash, "used_at": {"$ne": None}})
+        if replayed:
+            await db.refresh_tokens.delete_many({"family_id": replayed["family_id"]})
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    # Deactivation, deletion and role changes bump the token version
+    if stored["token_version"] != await get_token_version(stored["user_id"]):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    access_token = create_user_token(
+        {"id": stored["user_id"], "role": stored["role"], "token_version": stored["token_version"]},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    refresh_token = await issue_refresh_token(
+        stored["user_id"], stored["role"], stored["token_version"], family_id=stored["family_id"]
+    )
+    
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
 
 @api_router.get("/auth/me", response_model=User)
 async def read_users_me(current_user: User = Depends(get_current_user)):
@@ -416,36 +2890,12 @@ async def get_user_orders(current_user: User = Depends(get_current_user)):
     orders = await db.orders.find({"user_id": current_user.id}).to_list(1000)
     return [Order(**order) for order in orders]
 
-@api_router.post("/orders/{order_id}/upload")
-async def upload_file(
-    order_id: str, 
-    file: UploadFile = File(...), 
-    notes: Optional[str] = Form(None),
-    current_user: User = Depends(get_current_user)
-):
-    # Check if order exists and belongs to user
-    order = await db.orders.find_one({"id": order_id, "user_id": current_user.id})
-    if not order:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Order not found"
-        )
-    
-    # Check file size (10MB limit)
-    file_content = await file.read()
-    if len(file_content) > 10 * 1024 * 1024:  # 10MB
-        raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail="File too large. Maximum size is 10MB"
-        )
-    
-    # Store file in GridFS
-    file_id = fs.put(file_content, filename=file.filename, content_type=file.content_type)
-    
+async def attach_client_file(order_id: str, file_id: str, filename: str, notes: Optional[str], current_user: User) -> dict:
+    """Record a client's original file on their order and move it to processing"""
     # Create file version
     file_version = FileVersion(
-        file_id=str(file_id),
-        filename=file.filename,
+        file_id=file_id,
+        filename=filename,
         version_type="original",
         uploaded_by=current_user.id,
         notes=notes
@@ -478,43 +2928,67 @@ async def upload_file(
             }
         }
     )
+    await record_order_file(order_id, current_user.id, file_version)
     
     return {
         "message": "File uploaded successfully", 
-        "file_id": str(file_id),
+        "file_id": file_id,
         "notes": notes
     }
 
-@api_router.get("/orders/{order_id}/download/{file_id}")
-async def download_file(
+@api_router.post("/orders/{order_id}/upload")
+async def upload_file(
     order_id: str, 
-    file_id: str,
-    response: Response,
-    token: Optional[str] = Query(None),  # Allow token in query params for direct links
-    current_user: User = Depends(get_current_user_optional)  # Make user optional for query token
+    request: Request,
+    current_user: User = Depends(get_current_user)
 ):
-    # Add CORS headers to response
-    add_cors_headers(response)
+    # Check if order exists and belongs to user
+    order = await db.orders.find_one({"id": order_id, "user_id": current_user.id})
+    if not order:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Order not found"
+        )
     
-    # If no user from header and token in query, try to decode token
-    if not current_user and token:
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            user_id = payload.get("sub")
-            if user_id:
-                user_doc = await db.users.find_one({"id": user_id})
-                if user_doc:
-                    current_user = User(**user_doc)
-        except JWTError:
-            pass
+    # Stream the file into storage (10MB limit enforced while receiving),
+    # keeping a single copy of content that is already stored
+    upload = await ingest_upload(request)
+    file_id = await register_blob(upload, current_user.id)
+    
+    return await attach_client_file(order_id, file_id, upload["filename"], upload["fields"].get("notes"), current_user)
+
+@api_router.post("/orders/{order_id}/upload/by-hash")
+async def upload_file_by_hash(
+    order_id: str,
+    upload: UploadByHash,
+    current_user: User = Depends(get_current_user)
+):
+    # Check if order exists and belongs to user
+    order = await db.orders.find_one({"id": order_id, "user_id": current_user.id})
+    if not order:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Order not found"
+        )
     
-    if not current_user:
+    # Attach content we already store without the client sending it again;
+    # 404 tells the client to fall back to a regular upload
+    file_id = await claim_blob(upload.sha256, current_user.id)
+    if not file_id:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Authentication required"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File content not stored, upload it instead"
         )
     
-    # Check if order belongs to user
+    return await attach_client_file(order_id, file_id, upload.filename, upload.notes, current_user)
+
+@api_router.post("/orders/{order_id}/uploads", response_model=UploadSessionStatus)
+async def create_client_upload_session(
+    order_id: str,
+    upload: UploadSessionCreate,
+    current_user: User = Depends(get_current_user)
+):
+    # Check if order exists and belongs to user
     order = await db.orders.find_one({"id": order_id, "user_id": current_user.id})
     if not order:
         raise HTTPException(
@@ -522,44 +2996,191 @@ async def download_file(
             detail="Order not found"
         )
     
+    return upload_session_status(await create_upload_session(order, upload, current_user.id, "client"))
+
+@api_router.get("/uploads/{session_id}", response_model=UploadSessionStatus)
+async def get_upload_session_status(session_id: str, current_user: User = Depends(get_current_user)):
+    return upload_session_status(await get_upload_session(session_id, current_user))
+
+@api_router.put("/uploads/{session_id}/chunks/{index}", response_model=UploadSessionStatus)
+async def put_upload_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
+    session = await get_upload_session(session_id, current_user)
+    return upload_session_status(await stage_upload_chunk(session, index, request))
+
+@api_router.post("/uploads/{session_id}/complete")
+async def complete_upload_session(
+    session_id: str,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_user)
+):
+    session = await get_upload_session(session_id, current_user)
+    if session["state"] == "completed":
+        # The client lost the first response: answer the same again
+        return session["result"]
+    if session["kind"] == "admin" and current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    missing = upload_session_status(session).missing_chunks
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Missing chunks: {missing[:20]}"
+        )
+    
+    # Only one request gets to assemble the file
+    session = await db.upload_sessions.find_one_and_update(
+        {"id": session_id, "state": "open"},
+        {"$set": {"state": "finalizing", "finalizing_since": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if session is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload session is already being completed"
+        )
     try:
-        # Get file from GridFS
-        file_data = fs.get(ObjectId(file_id))
-        
-        # Get filename from order files
-        filename = "download.bin"
-        if "files" in order:
-            for file_info in order["files"]:
-                if file_info.get("file_id") == file_id:
-                    filename = file_info.get("filename", "download.bin")
-                    break
-        
-        return StreamingResponse(
-            io.BytesIO(file_data.read()),
-            media_type="application/octet-stream",
-            headers={
-                "Content-Disposition": f"attachment; filename={filename}",
-                "Access-Control-Allow-Origin": "https://engine-tune-portal.emergent.host",
-                "Access-Control-Allow-Credentials": "true",
-                "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
-                "Access-Control-Allow-Headers": "*"
-            }
+        upload = await assemble_upload_session(session)
+        if session["sha256"] and session["sha256"] != upload["sha256"]:
+            await storage.delete(upload["file_id"])
+            await discard_upload_session(session)
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Uploaded content does not match its SHA-256, start a new upload"
+            )
+    
+        if session["kind"] == "admin":
+            order = await db.orders.find_one({"id": session["order_id"]})
+            if not order:
+                await storage.delete(upload["file_id"])
+                await discard_upload_session(session)
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Order not found"
+                )
+            result = await attach_admin_file(
+                order, upload, session["version_type"], session["notes"],
+                Principal(id=current_user.id, role=current_user.role), background_tasks
+            )
+        else:
+            file_id = await register_blob(upload, current_user.id)
+            result = await attach_client_file(session["order_id"], file_id, session["filename"], session["notes"], current_user)
+    
+        # Keep the session briefly so a retried completion gets the same answer
+        await db.upload_sessions.update_one(
+            {"id": session_id},
+            {"$set": {"state": "completed", "result": result, "chunks": {}, "expires_at": datetime.utcnow() + timedelta(hours=1)},
+             "$unset": {"finalizing_since": ""}}
         )
-        
-    except Exception as e:
+    except BaseException:
+        await reopen_upload_session(session_id)
+        raise
+    for chunk in session["chunks"].values():
+        await storage.delete(chunk["file_id"])
+    return result
+
+@api_router.delete("/uploads/{session_id}")
+async def abort_upload_session(session_id: str, current_user: User = Depends(get_current_user)):
+    session = await get_upload_session(session_id, current_user)
+    if session["state"] == "finalizing":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload session is being completed"
+        )
+    await discard_upload_session(session)
+    return {"message": "Upload session discarded"}
+
+@api_router.api_route("/orders/{order_id}/download/{file_id}", methods=["GET", "HEAD"])
+async def download_file(
+    order_id: str, 
+    file_id: str,
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
+    # Only files of the user's own orders
+    file_info = await get_order_file(order_id, file_id, current_user.id)
+    if not file_info:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found"
         )
+    
+    return await build_file_response(request, file_id, file_info.get("filename", "download.bin"))
+
+@api_router.get("/orders/{order_id}/archive")
+async def download_order_archive(
+    order_id: str,
+    file_id: Optional[List[str]] = Query(None),
+    current_user: User = Depends(get_current_user)
+):
+    # All files of the order, or only the file_id ones, in a single streamed ZIP
+    order = await db.orders.find_one({"id": order_id, "user_id": current_user.id})
+    if not order:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Order not found"
+        )
+    
+    return await build_zip_response(order, select_order_files(order, file_id))
+
+@api_router.post("/orders/{order_id}/files/{file_id}/link", response_model=DownloadLink)
+async def create_file_link(
+    order_id: str,
+    file_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    file_info = await get_order_file(order_id, file_id, current_user.id)
+    if not file_info:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
+        )
+    
+    return create_download_link(order_id, file_id, file_info.get("filename", "download.bin"))
+
+@api_router.get("/files", response_model=List[OrderFile])
+async def get_user_files(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: User = Depends(get_current_user)
+):
+    # Every file of the user's orders, newest first
+    cursor = db.order_files.find({"owner_id": current_user.id}).sort("uploaded_at", -1).skip(skip).limit(limit)
+    return [OrderFile(**file_info) async for file_info in cursor]
+
+@api_router.api_route("/files/{order_id}/{file_id}", methods=["GET", "HEAD"])
+async def download_signed_file(
+    order_id: str,
+    file_id: str,
+    request: Request,
+    filename: str = Query(...),
+    expires: int = Query(...),
+    signature: str = Query(...)
+):
+    # The signature is the authorization: no user or order lookup needed
+    expected = sign_download(order_id, file_id, filename, expires)
+    if not hmac.compare_digest(expected, signature) or expires < time.time():
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid or expired download link"
+        )
+    
+    return await build_file_response(request, file_id, filename)
 
 # Admin routes
 @api_router.get("/admin/users", response_model=List[User])
-async def get_all_users(admin_user: User = Depends(get_admin_user)):
+async def get_all_users(admin_user: Principal = Depends(get_admin_user)):
     users = await db.users.find().to_list(1000)
     return [User(**user) for user in users]
 
 @api_router.post("/admin/users", response_model=User)
-async def create_user(user: UserCreate, admin_user: User = Depends(get_admin_user)):
+async def create_user(user: UserCreate, admin_user: Principal = Depends(get_admin_user)):
     # Check if user already exists
     existing_user = await db.users.find_one({"email": user.email})
     if existing_user:
@@ -570,7 +3191,7 @@ async def create_user(user: UserCreate, admin_user: User = Depends(get_admin_use
     
     # Create new user
     user_dict = user.dict()
-    user_dict["password"] = hash_password(user.password)
+    user_dict["password"] = await hash_password_async(user.password)
     new_user = User(**user_dict)
     user_db_dict = new_user.dict()
     user_db_dict["password"] = user_dict["password"]
@@ -579,7 +3200,7 @@ async def create_user(user: UserCreate, admin_user: User = Depends(get_admin_use
     return new_user
 
 @api_router.put("/admin/users/{user_id}", response_model=User)
-async def update_user(user_id: str, user_update: UserUpdate, admin_user: User = Depends(get_admin_user)):
+async def update_user(user_id: str, user_update: UserUpdate, admin_user: Principal = Depends(get_admin_user)):
     # Find user
     existing_user = await db.users.find_one({"id": user_id})
     if not existing_user:
@@ -599,13 +3220,17 @@ async def update_user(user_id: str, user_update: UserUpdate, admin_user: User =
             {"id": user_id},
             {"$set": update_data}
         )
+        if "role" in update_data or update_data.get("is_active") is False:
+            await revoke_user_tokens(user_id)
+        else:
+            user_cache.invalidate(user_id)
     
     # Return updated user
     updated_user = await db.users.find_one({"id": user_id})
     return User(**updated_user)
 
 @api_router.delete("/admin/users/{user_id}")
-async def delete_user(user_id: str, admin_user: User = Depends(get_admin_user)):
+async def delete_user(user_id: str, admin_user: Principal = Depends(get_admin_user)):
     # Check if user exists
     existing_user = await db.users.find_one({"id": user_id})
     if not existing_user:
@@ -623,10 +3248,21 @@ async def delete_user(user_id: str, admin_user: User = Depends(get_admin_user)):
     
     # Delete user
     await db.users.delete_one({"id": user_id})
+    await revoke_user_tokens(user_id)
     return {"message": "User deleted successfully"}
 
+@api_router.get("/admin/users/{user_id}/files", response_model=List[OrderFile])
+async def get_client_files(
+    user_id: str,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    admin_user: Principal = Depends(get_admin_user)
+):
+    cursor = db.order_files.find({"owner_id": user_id}).sort("uploaded_at", -1).skip(skip).limit(limit)
+    return [OrderFile(**file_info) async for file_info in cursor]
+
 @api_router.get("/admin/orders", response_model=List[Order])
-async def get_all_orders(admin_user: User = Depends(get_admin_user)):
+async def get_all_orders(admin_user: Principal = Depends(get_admin_user)):
     orders = await db.orders.find().to_list(1000)
     return [Order(**order) for order in orders]
 
@@ -634,7 +3270,7 @@ async def get_all_orders(admin_user: User = Depends(get_admin_user)):
 async def update_order_status(
     order_id: str, 
     status_update: OrderStatusUpdate, 
-    admin_user: User = Depends(get_admin_user)
+    admin_user: Principal = Depends(get_admin_user)
 ):
     update_data = {
         "status": status_update.status,
@@ -659,7 +3295,7 @@ async def update_order_status(
 async def update_order_price(
     order_id: str,
     price_data: dict,
-    admin_user: User = Depends(get_admin_user)
+    admin_user: Principal = Depends(get_admin_user)
 ):
     price = price_data.get("price")
     if price is None or price < 0:
@@ -679,62 +3315,52 @@ async def update_order_price(
         )
     return {"message": "Order price updated"}
 
-@api_router.get("/admin/orders/{order_id}/download/{file_id}")
+@api_router.api_route("/admin/orders/{order_id}/download/{file_id}", methods=["GET", "HEAD"])
 async def admin_download_file(
     order_id: str, 
     file_id: str,
-    response: Response,
-    admin_user: User = Depends(get_admin_user)
+    request: Request,
+    admin_user: Principal = Depends(get_admin_user)
 ):
-    # Add CORS headers to response
-    add_cors_headers(response)
-    
-    # Check if order exists
-    order = await db.orders.find_one({"id": order_id})
-    if not order:
+    file_info = await get_order_file(order_id, file_id)
+    if not file_info:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="Order not found"
+            detail="File not found"
         )
     
-    try:
-        # Get file from GridFS
-        file_data = fs.get(ObjectId(file_id))
-        
-        # Get filename from order files
-        filename = "download.bin"
-        if "files" in order:
-            for file_info in order["files"]:
-                if file_info.get("file_id") == file_id:
-                    filename = file_info.get("filename", "download.bin")
-                    break
-        
-        return StreamingResponse(
-            io.BytesIO(file_data.read()),
-            media_type="application/octet-stream",
-            headers={
-                "Content-Disposition": f"attachment; filename={filename}",
-                "Access-Control-Allow-Origin": "https://engine-tune-portal.emergent.host",
-                "Access-Control-Allow-Credentials": "true",
-                "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
-                "Access-Control-Allow-Headers": "*"
-            }
-        )
-    except Exception as e:
+    return await build_file_response(request, file_id, file_info.get("filename", "download.bin"))
+
+@api_router.get("/admin/orders/{order_id}/files/{file_id}/analysis")
+async def admin_get_file_analysis(
+    order_id: str,
+    file_id: str,
+    admin_user: Principal = Depends(get_admin_user)
+):
+    if not await get_order_file(order_id, file_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found"
         )
+    
+    blob = await db.blobs.find_one({"file_id": file_id})
+    if not blob or "analysis_state" not in blob:
+        # Stored before the analysis pipeline existed
+        return {"file_id": file_id, "state": "unavailable", "results": {}}
+    return {
+        "file_id": file_id,
+        "state": blob["analysis_state"],
+        "results": blob.get("analysis", {}),
+        "truncated": blob.get("analysis_truncated", False),
+        "analyzed_at": blob.get("analyzed_at"),
+    }
 
-@api_router.post("/admin/orders/{order_id}/upload")
-async def admin_upload_file(
+@api_router.get("/admin/orders/{order_id}/archive")
+async def admin_download_order_archive(
     order_id: str,
-    file: UploadFile = File(...),
-    version_type: str = Form("v1"),  # v1, v2, v3, sav
-    notes: Optional[str] = Form(None),
-    admin_user: User = Depends(get_admin_user)
+    file_id: Optional[List[str]] = Query(None),
+    admin_user: Principal = Depends(get_admin_user)
 ):
-    # Check if order exists
     order = await db.orders.find_one({"id": order_id})
     if not order:
         raise HTTPException(
@@ -742,21 +3368,44 @@ async def admin_upload_file(
             detail="Order not found"
         )
     
-    # Check file size (10MB limit)
-    file_content = await file.read()
-    if len(file_content) > 10 * 1024 * 1024:  # 10MB
+    return await build_zip_response(order, select_order_files(order, file_id))
+
+@api_router.post("/admin/orders/{order_id}/files/{file_id}/link", response_model=DownloadLink)
+async def admin_create_file_link(
+    order_id: str,
+    file_id: str,
+    admin_user: Principal = Depends(get_admin_user)
+):
+    file_info = await get_order_file(order_id, file_id)
+    if not file_info:
         raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail="File too large. Maximum size is 10MB"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
         )
     
-    # Store file in GridFS
-    file_id = fs.put(file_content, filename=file.filename, content_type=file.content_type)
+    return create_download_link(order_id, file_id, file_info.get("filename", "download.bin"))
+
+async def attach_admin_file(
+    order: dict,
+    upload: dict,
+    version_type: str,
+    notes: Optional[str],
+    admin_user: Principal,
+    background_tasks: BackgroundTasks
+) -> dict:
+    """Record a freshly stored file as a new version of the order and notify the client"""
+    # A tuned version only changes a few maps: keep it as patches against the original
+    originals = [f["file_id"] for f in order.get("files", []) if f.get("version_type") == "original"]
+    if version_type != "original" and originals and not await db.blobs.find_one({"sha256": upload["sha256"]}, {"_id": 1}):
+        await store_as_delta(upload, originals[-1])
+    file_id = await register_blob(upload, order["user_id"])
+    # The client is notified right away and usually downloads it within minutes
+    background_tasks.add_task(storage.warm, file_id)
     
     # Create file version
     file_version = FileVersion(
-        file_id=str(file_id),
-        filename=file.filename,
+        file_id=file_id,
+        filename=upload["filename"],
         version_type=version_type,
         uploaded_by=admin_user.id,
         notes=notes
@@ -764,7 +3413,7 @@ async def admin_upload_file(
     
     # Update order with new file version
     await db.orders.update_one(
-        {"id": order_id},
+        {"id": order["id"]},
         {
             "$push": {
                 "files": file_version.dict()
@@ -774,6 +3423,7 @@ async def admin_upload_file(
             }
         }
     )
+    await record_order_file(order["id"], order["user_id"], file_version)
     
     # Create notification for CLIENT ONLY about new file
     immatriculation = order.get("immatriculation", "")
@@ -784,7 +3434,7 @@ async def admin_upload_file(
         type="new_file",
         title="Nouveau fichier disponible",
         message=f"{version_text} disponible pour {service_info}",
-        order_id=order_id,
+        order_id=order["id"],
         user_id=order.get("user_id")  # ONLY for the client, not admin
     )
     
@@ -797,20 +3447,58 @@ async def admin_upload_file(
         "notes": notes
     }
 
+@api_router.post("/admin/orders/{order_id}/upload")
+async def admin_upload_file(
+    order_id: str,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    admin_user: Principal = Depends(get_admin_user)
+):
+    # Check if order exists
+    order = await db.orders.find_one({"id": order_id})
+    if not order:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Order not found"
+        )
+    
+    # Stream the file into storage (10MB limit enforced while receiving),
+    # keeping a single copy of content that is already stored
+    upload = await ingest_upload(request)
+    version_type = upload["fields"].get("version_type", "v1")  # v1, v2, v3, sav
+    notes = upload["fields"].get("notes")
+    return await attach_admin_file(order, upload, version_type, notes, admin_user, background_tasks)
+
+@api_router.post("/admin/orders/{order_id}/uploads", response_model=UploadSessionStatus)
+async def create_admin_upload_session(
+    order_id: str,
+    upload: UploadSessionCreate,
+    admin_user: Principal = Depends(get_admin_user)
+):
+    # Check if order exists
+    order = await db.orders.find_one({"id": order_id})
+    if not order:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Order not found"
+        )
+    
+    return upload_session_status(await create_upload_session(order, upload, admin_user.id, "admin"))
+
 # Service management routes
 @api_router.get("/admin/services", response_model=List[Service])
-async def get_all_services(admin_user: User = Depends(get_admin_user)):
+async def get_all_services(admin_user: Principal = Depends(get_admin_user)):
     services = await db.services.find().to_list(1000)
     return [Service(**service) for service in services]
 
 @api_router.post("/admin/services", response_model=Service)
-async def create_service(service: ServiceCreate, admin_user: User = Depends(get_admin_user)):
+async def create_service(service: ServiceCreate, admin_user: Principal = Depends(get_admin_user)):
     new_service = Service(**service.dict())
     await db.services.insert_one(new_service.dict())
     return new_service
 
 @api_router.put("/admin/services/{service_id}", response_model=Service)
-async def update_service(service_id: str, service_update: ServiceUpdate, admin_user: User = Depends(get_admin_user)):
+async def update_service(service_id: str, service_update: ServiceUpdate, admin_user: Principal = Depends(get_admin_user)):
     # Find service
     existing_service = await db.services.find_one({"id": service_id})
     if not existing_service:
@@ -836,7 +3524,7 @@ async def update_service(service_id: str, service_update: ServiceUpdate, admin_u
     return Service(**updated_service)
 
 @api_router.delete("/admin/services/{service_id}")
-async def delete_service(service_id: str, admin_user: User = Depends(get_admin_user)):
+async def delete_service(service_id: str, admin_user: Principal = Depends(get_admin_user)):
     result = await db.services.delete_one({"id": service_id})
     if result.deleted_count == 0:
         raise HTTPException(
@@ -851,7 +3539,7 @@ async def delete_service(service_id: str, admin_user: User = Depends(get_admin_u
 async def update_order_payment_status(
     order_id: str,
     payment_update: PaymentStatusUpdate,
-    admin_user: User = Depends(get_admin_user)
+    admin_user: Principal = Depends(get_admin_user)
 ):
     result = await db.orders.update_one(
         {"id": order_id},
@@ -867,7 +3555,7 @@ async def update_order_payment_status(
 @api_router.put("/admin/orders/{order_id}/cancel")
 async def cancel_order(
     order_id: str,
-    admin_user: User = Depends(get_admin_user)
+    admin_user: Principal = Depends(get_admin_user)
 ):
     update_data = {
         "status": "cancelled",
@@ -887,7 +3575,7 @@ async def cancel_order(
     return {"message": "Order cancelled"}
 
 @api_router.get("/admin/orders/by-client")
-async def get_orders_by_client(admin_user: User = Depends(get_admin_user)):
+async def get_orders_by_client(admin_user: Principal = Depends(get_admin_user)):
     # Get all orders and group by user
     orders = await db.orders.find({}).to_list(1000)
     users = await db.users.find({}).to_list(1000)
@@ -922,7 +3610,7 @@ async def get_orders_by_client(admin_user: User = Depends(get_admin_user)):
     return list(orders_by_client.values())
 
 @api_router.get("/admin/orders/pending")
-async def get_pending_orders(admin_user: User = Depends(get_admin_user)):
+async def get_pending_orders(admin_user: Principal = Depends(get_admin_user)):
     # Get all orders that are not completed or cancelled
     orders = await db.orders.find({
         "status": {"$nin": ["completed", "cancelled"]}
@@ -955,7 +3643,7 @@ async def get_pending_orders(admin_user: User = Depends(get_admin_user)):
 async def update_user_status(
     user_id: str,
     status_update: UserStatusUpdate,
-    admin_user: User = Depends(get_admin_user)
+    admin_user: Principal = Depends(get_admin_user)
 ):
     result = await db.users.update_one(
         {"id": user_id},
@@ -966,8 +3654,81 @@ async def update_user_status(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
+    if status_update.is_active:
+        token_version_cache.invalidate(user_id)
+        user_cache.invalidate(user_id)
+    else:
+        await revoke_user_tokens(user_id)
     return {"message": "User status updated"}
 
+@api_router.post("/admin/exports", response_model=ExportSummary)
+async def create_file_export(filters: ExportFilter, admin_user: Principal = Depends(get_admin_user)):
+    export = await create_export(filters, admin_user)
+    return ExportSummary(
+        id=export["id"],
+        orders=export["orders"],
+        files=len(export["entries"]),
+        size=export["size"],
+        expires_at=export["expires_at"],
+        url=f"/api/admin/exports/{export['id']}/archive"
+    )
+
+@api_router.api_route("/admin/exports/{export_id}/archive", methods=["GET", "HEAD"])
+async def download_file_export(
+    export_id: str,
+    request: Request,
+    admin_user: Principal = Depends(get_admin_user)
+):
+    # The archive is rebuilt from the manifest on every request, so an
+    # interrupted download resumes with a Range request
+    export = await db.exports.find_one({"id": export_id})
+    if not export:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Export not found or expired"
+        )
+    
+    return build_export_response(request, export)
+
+@api_router.get("/admin/storage/report")
+async def storage_report(admin_user: Principal = Depends(get_admin_user)):
+    return await get_storage_report()
+
+@api_router.get("/admin/storage/clients", response_model=List[StorageClientUsage])
+async def storage_by_client(
+    limit: int = Query(50, ge=1, le=1000),
+    admin_user: Principal = Depends(get_admin_user)
+):
+    # Content shared between orders counts once per order: this is what each client sees, not what is stored
+    usage = db.order_files.aggregate([
+        {"$group": {
+            "_id": "$owner_id",
+            "files": {"$sum": 1},
+            "bytes": {"$sum": {"$ifNull": ["$length", 0]}},
+            "last_upload_at": {"$max": "$uploaded_at"}
+        }},
+        {"$sort": {"bytes": -1}},
+        {"$limit": limit}
+    ])
+    return [StorageClientUsage(owner_id=row.pop("_id"), **row) async for row in usage]
+
+@api_router.get("/admin/metrics")
+async def get_metrics(admin_user: Principal = Depends(get_admin_user)):
+    return {
+        "bcrypt_rounds": BCRYPT_ROUNDS,
+        "user_cache": user_cache.stats(),
+        "token_versions": token_version_cache.stats(),
+        "jwt_cache": jwt_cache.stats(),
+        "delta_cache": delta_cache.stats(),
+        "file_cache": file_cache.stats(),
+        "analysis": analysis_pipeline.stats(),
+        "bcrypt": bcrypt_executor.stats(),
+        "login_limiter": {
+            "ip": login_ip_limiter.stats(),
+            "email": login_email_limiter.stats(),
+        }
+    }
+
 @api_router.get("/client/balance")
 async def get_client_balance(current_user: User = Depends(get_current_user)):
     # Calculate unpaid orders total for current user
@@ -1011,14 +3772,14 @@ async def create_sav_request(
     return {"message": "Demande de SAV créée avec succès"}
 
 @api_router.get("/admin/notifications")
-async def get_admin_notifications(admin_user: User = Depends(get_admin_user)):
+async def get_admin_notifications(admin_user: Principal = Depends(get_admin_user)):
     notifications = await db.notifications.find({}).sort("created_at", -1).to_list(50)
     return [Notification(**notif) for notif in notifications]
 
 @api_router.put("/admin/notifications/{notification_id}/read")
 async def mark_notification_read(
     notification_id: str,
-    admin_user: User = Depends(get_admin_user)
+    admin_user: Principal = Depends(get_admin_user)
 ):
     await db.notifications.update_one(
         {"id": notification_id},
@@ -1029,7 +3790,7 @@ async def mark_notification_read(
 @api_router.delete("/admin/notifications/{notification_id}")
 async def delete_notification(
     notification_id: str,
-    admin_user: User = Depends(get_admin_user)
+    admin_user: Principal = Depends(get_admin_user)
 ):
     result = await db.notifications.delete_one({"id": notification_id})
     if result.deleted_count == 0:
@@ -1041,7 +3802,7 @@ async def delete_notification(
 
 @api_router.delete("/admin/notifications")
 async def delete_all_notifications(
-    admin_user: User = Depends(get_admin_user)
+    admin_user: Principal = Depends(get_admin_user)
 ):
     # Admin can delete ALL notifications (not just their own)
     result = await db.notifications.delete_many({})
@@ -1049,7 +3810,7 @@ async def delete_all_notifications(
 
 # Chat endpoints
 @api_router.get("/admin/chat/conversations")
-async def get_admin_conversations(admin_user: User = Depends(get_admin_user)):
+async def get_admin_conversations(admin_user: Principal = Depends(get_admin_user)):
     # Get all client users
     users = await db.users.find({"role": "client"}).to_list(1000)
     
@@ -1106,7 +3867,7 @@ async def get_admin_conversations(admin_user: User = Depends(get_admin_user)):
     return conversation_list
 
 @api_router.get("/admin/chat/{user_id}/messages")
-async def get_chat_messages(user_id: str, admin_user: User = Depends(get_admin_user)):
+async def get_chat_messages(user_id: str, admin_user: Principal = Depends(get_admin_user)):
     messages = await db.messages.find({"user_id": user_id}).sort("created_at", 1).to_list(1000)
     
     # Mark admin messages as read
@@ -1121,7 +3882,7 @@ async def get_chat_messages(user_id: str, admin_user: User = Depends(get_admin_u
 async def send_admin_message(
     user_id: str,
     message_data: dict,
-    admin_user: User = Depends(get_admin_user)
+    admin_user: Principal = Depends(get_admin_user)
 ):
     message = Message(
         user_id=user_id,
@@ -1226,7 +3987,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition", "Content-Type", "Content-Length"]
+    expose_headers=["Content-Disposition", "Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "ETag"]
 )
 
 # Configure logging
@@ -1236,10 +3997,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+upload_session_gc_task = None
+
 @app.on_event("startup")
 async def startup_event():
+    global BCRYPT_ROUNDS
+    if BCRYPT_TARGET_MS > 0:
+        loop = asyncio.get_running_loop()
+        BCRYPT_ROUNDS = await loop.run_in_executor(None, calibrate_bcrypt_rounds, BCRYPT_TARGET_MS)
+        logger.info(f"bcrypt cost calibrated to {BCRYPT_ROUNDS} for a {BCRYPT_TARGET_MS:.0f}ms target")
     await init_db()
+    global upload_session_gc_task
+    upload_session_gc_task = asyncio.create_task(run_upload_session_gc())
+    analysis_pipeline.start()
+    requeued = await analysis_pipeline.requeue_pending()
+    if requeued:
+        logger.info(f"Queued {requeued} files still waiting for analysis")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    if upload_session_gc_task:
+        upload_session_gc_task.cancel()
+    analysis_pipeline.stop()
+    client.close()
+    bcrypt_executor.shutdown()
+    file_cache.close()
\ No newline at end of file
@@ -52,6 +52,10 @@ async def clean_production_database():
         
         # Supprimer toutes les commandes
         orders_result = await db.orders.delete_many({})
+        # Plus aucune commande: l'index de déduplication ne doit plus renvoyer vers ces fichiers
+        await db.blobs.delete_many({})
+        # L'index des fichiers autorise les téléchargements: il part avec les commandes
+        await db.order_files.delete_many({})
         print(f'✅ {orders_result.deleted_count} commandes supprimées')
         print(f'✅ {deleted_files} fichiers supprimés')
     
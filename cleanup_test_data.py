@@ -79,6 +79,10 @@ async def cleanup_test_data():
         deleted_orders += 1
         print(f"🗑️  Commande supprimée: {order.get('order_number', 'ID inconnu')}")
     
+    # Plus aucune commande: l'index de déduplication ne doit plus renvoyer vers ces fichiers
+    await db.blobs.delete_many({})
+    # L'index des fichiers autorise les téléchargements: il part avec les commandes
+    await db.order_files.delete_many({})
     print(f"✅ {deleted_orders} commandes supprimées")
     print(f"✅ {deleted_files} fichiers supprimés")
     
@@ -48,6 +48,10 @@ async def force_clean_all():
     
     # Supprimer toutes les commandes d'un coup
     delete_orders_result = await db.orders.delete_many({})
+    # Plus aucune commande: l'index de déduplication ne doit plus renvoyer vers ces fichiers
+    await db.blobs.delete_many({})
+    # L'index des fichiers autorise les téléchargements: il part avec les commandes
+    await db.order_files.delete_many({})
     print(f'   ✅ {delete_orders_result.deleted_count} commandes supprimées')
     print(f'   ✅ {total_files_deleted} fichiers supprimés')
     
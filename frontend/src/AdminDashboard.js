@@ -408,15 +408,10 @@ const AdminDashboard = ({ user, onLogout, apiService }) => {
   const handleDownload = async (orderId, fileId, filename) => {
     try {
       console.log(`[ADMIN] Downloading file: ${filename} (Order: ${orderId}, File: ${fileId})`);
-      const response = await apiService.adminDownloadFile(orderId, fileId);
-      
-      // Create blob from response data
-      const blob = new Blob([response.data], { 
-        type: response.headers['content-type'] || 'application/octet-stream' 
-      });
+      // Signed short-lived link: the browser streams the file straight to disk
+      const url = await apiService.adminGetDownloadLink(orderId, fileId);
       
       // Create download link
-      const url = window.URL.createObjectURL(blob);
       const link = document.createElement('a');
       link.href = url;
       link.download = filename || `cartography-${orderId}.bin`;
@@ -425,12 +420,7 @@ const AdminDashboard = ({ user, onLogout, apiService }) => {
       link.style.display = 'none';
       document.body.appendChild(link);
       link.click();
-      
-      // Cleanup
-      setTimeout(() => {
-        document.body.removeChild(link);
-        window.URL.revokeObjectURL(url);
-      }, 100);
+      document.body.removeChild(link);
       
       console.log(`✅ [ADMIN] Download completed: ${filename}`);
     } catch (error) {
@@ -43,19 +43,45 @@ const ThemeProvider = ({ children }) => {
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Files above this size are sent in chunks through a resumable upload session
+const CHUNKED_UPLOAD_THRESHOLD = 10 * 1024 * 1024;
+const CHUNK_UPLOAD_ATTEMPTS = 3;
+
+// Single in-flight refresh shared by every request that hits a 401
+let refreshPromise = null;
+
 // Auth Service
 const authService = {
   login: async (email, password) => {
     const response = await axios.post(`${API}/auth/login`, { email, password });
     localStorage.setItem('token', response.data.access_token);
+    if (response.data.refresh_token) {
+      localStorage.setItem('refresh_token', response.data.refresh_token);
+    }
     return response.data;
   },
   register: async (userData) => {
     const response = await axios.post(`${API}/auth/register`, userData);
     return response.data;
   },
+  refresh: () => {
+    if (!refreshPromise) {
+      const refreshToken = localStorage.getItem('refresh_token');
+      refreshPromise = axios.post(`${API}/auth/refresh`, { refresh_token: refreshToken })
+        .then((response) => {
+          localStorage.setItem('token', response.data.access_token);
+          localStorage.setItem('refresh_token', response.data.refresh_token);
+          return response.data.access_token;
+        })
+        .finally(() => {
+          refreshPromise = null;
+        });
+    }
+    return refreshPromise;
+  },
   logout: () => {
     localStorage.removeItem('token');
+    localStorage.removeItem('refresh_token');
   },
   getToken: () => {
     return localStorage.getItem('token');
@@ -76,6 +102,33 @@ const authService = {
   }
 };
 
+// Renew an expired access token with the refresh token and replay the request once
+axios.interceptors.response.use(
+  (response) => response,
+  async (error) => {
+    const original = error.config;
+    const isAuthCall = original && /\/auth\/(login|refresh)$/.test(original.url);
+    if (
+      error.response &&
+      error.response.status === 401 &&
+      original &&
+      !original._retried &&
+      !isAuthCall &&
+      localStorage.getItem('refresh_token')
+    ) {
+      original._retried = true;
+      try {
+        const accessToken = await authService.refresh();
+        original.headers.Authorization = `Bearer ${accessToken}`;
+        return axios(original);
+      } catch (refreshError) {
+        authService.logout();
+      }
+    }
+    return Promise.reject(error);
+  }
+);
+
 // API Service
 const apiService = {
   // Services
@@ -119,6 +172,31 @@ const apiService = {
   // Files
   uploadFile: async (orderId, file, notes = '') => {
     const token = authService.getToken();
+    let sha256 = null;
+    
+    // Offer the SHA-256 first: content the server already holds is attached
+    // without sending the bytes again (404 means it has to be uploaded).
+    // Hashing reads the whole file into memory, so large files skip it.
+    if (file.size <= CHUNKED_UPLOAD_THRESHOLD && window.crypto && window.crypto.subtle) {
+      try {
+        const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        sha256 = Array.from(new Uint8Array(digest))
+          .map((byte) => byte.toString(16).padStart(2, '0'))
+          .join('');
+        const response = await axios.post(`${API}/orders/${orderId}/upload/by-hash`,
+          { sha256, filename: file.name, notes: notes || null },
+          { headers: { Authorization: `Bearer ${token}` } }
+        );
+        return response.data;
+      } catch (error) {
+        if (error.response?.status !== 404) throw error;
+      }
+    }
+    
+    if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+      return apiService.uploadFileInChunks(`${API}/orders/${orderId}/uploads`, file, { notes: notes || null, sha256 });
+    }
+    
     const formData = new FormData();
     formData.append('file', file);
     if (notes) formData.append('notes', notes);
@@ -131,6 +209,35 @@ const apiService = {
     });
     return response.data;
   },
+  // Large files go through a resumable session: only the chunks the server
+  // does not have yet are sent, each retried on its own after a network error
+  uploadFileInChunks: async (sessionUrl, file, fields) => {
+    const token = authService.getToken();
+    const headers = { Authorization: `Bearer ${token}` };
+    const session = (await axios.post(sessionUrl,
+      { filename: file.name, length: file.size, ...fields },
+      { headers }
+    )).data;
+    
+    for (const index of session.missing_chunks) {
+      const start = index * session.chunk_size;
+      const chunk = file.slice(start, Math.min(start + session.chunk_size, file.size));
+      for (let attempt = 1; ; attempt++) {
+        try {
+          await axios.put(`${API}/uploads/${session.id}/chunks/${index}`, chunk, {
+            headers: { ...headers, 'Content-Type': 'application/octet-stream' }
+          });
+          break;
+        } catch (error) {
+          if (attempt >= CHUNK_UPLOAD_ATTEMPTS || (error.response && error.response.status < 500)) throw error;
+          await new Promise((resolve) => setTimeout(resolve, 1000 * attempt));
+        }
+      }
+    }
+    
+    const response = await axios.post(`${API}/uploads/${session.id}/complete`, {}, { headers });
+    return response.data;
+  },
   downloadFile: async (orderId, fileId) => {
     const token = authService.getToken();
     const response = await axios.get(`${API}/orders/${orderId}/download/${fileId}`, {
@@ -139,6 +246,13 @@ const apiService = {
     });
     return response;
   },
+  getDownloadLink: async (orderId, fileId) => {
+    const token = authService.getToken();
+    const response = await axios.post(`${API}/orders/${orderId}/files/${fileId}/link`, {}, {
+      headers: { Authorization: `Bearer ${token}` }
+    });
+    return `${BACKEND_URL}${response.data.url}`;
+  },
   
   // Admin APIs
   adminGetUsers: async () => {
@@ -279,7 +393,19 @@ const apiService = {
     });
     return response;
   },
+  adminGetDownloadLink: async (orderId, fileId) => {
+    const token = authService.getToken();
+    const response = await axios.post(`${API}/admin/orders/${orderId}/files/${fileId}/link`, {}, {
+      headers: { Authorization: `Bearer ${token}` }
+    });
+    return `${BACKEND_URL}${response.data.url}`;
+  },
   adminUploadFile: async (orderId, file, versionType, notes = '') => {
+    if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+      return apiService.uploadFileInChunks(`${API}/admin/orders/${orderId}/uploads`, file,
+        { notes: notes || null, version_type: versionType });
+    }
+    
     const token = authService.getToken();
     const formData = new FormData();
     formData.append('file', file);
@@ -1301,8 +1427,8 @@ const ClientDashboard = ({ user, onLogout }) => {
       if (error.response?.status === 404) {
         console.log('🔄 Trying fallback direct download...');
         try {
-          const token = authService.getToken();
-          const fallbackUrl = `${API}/orders/${orderId}/download/${fileId}?token=${token}`;
+          // Signed short-lived link: the browser streams the file straight to disk
+          const fallbackUrl = await apiService.getDownloadLink(orderId, fileId);
           
           const link = document.createElement('a');
           link.href = fallbackUrl;
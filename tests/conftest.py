@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# server.py lives in backend/ and is imported as a top-level module, like the scripts next to it do
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
@@ -0,0 +1,50 @@
+import pytest
+
+from server import MAX_BYTE_RANGES, accepts_encoding, parse_range_header
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", [(0, 99)]),
+    ("bytes=100-", [(100, 999)]),
+    ("bytes=-100", [(900, 999)]),
+    ("bytes=-5000", [(0, 999)]),
+    ("bytes=900-5000", [(900, 999)]),
+    ("bytes=0-0, 10-19", [(0, 0), (10, 19)]),
+])
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [
+    None,
+    "",
+    "items=0-10",
+    "bytes=abc",
+    "bytes=5-x",
+    "bytes=10-5",
+    "bytes=" + ",".join(f"{i}-{i}" for i in range(MAX_BYTE_RANGES + 1)),
+])
+def test_parse_range_header_falls_back_to_the_full_body(header):
+    assert parse_range_header(header, 1000) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5000-6000", "bytes=-0"])
+def test_parse_range_header_unsatisfiable(header):
+    assert parse_range_header(header, 1000) == []
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, False),
+    ("", False),
+    ("zstd", True),
+    ("gzip, deflate, br, zstd", True),
+    ("gzip, ZSTD;q=0.5", True),
+    ("zstd;q=0", False),
+    ("zstd;q=0.0", False),
+    ("zstd;q=abc", False),
+    ("gzip, *", True),
+    ("gzip, deflate", False),
+    ("zstdx", False),
+])
+def test_accepts_encoding(header, expected):
+    assert accepts_encoding(header, "zstd") is expected
@@ -0,0 +1,112 @@
+import asyncio
+import os
+
+import pytest
+
+from server import (
+    DELTA_BLOCK_BYTES, MemoryStoredFile, compute_delta, decode_delta, encode_delta,
+    iter_delta_content, iter_patched,
+)
+
+
+def collect(chunks) -> bytes:
+    async def read():
+        return b"".join([bytes(chunk) async for chunk in chunks])
+    return asyncio.run(read())
+
+
+async def iter_chunks(data: bytes, size: int = 1000):
+    for offset in range(0, len(data), size):
+        yield data[offset:offset + size]
+
+
+def stored(file_id: str, data: bytes, metadata: dict = None) -> MemoryStoredFile:
+    return MemoryStoredFile(file_id, f"{file_id}.bin", metadata or {}, data)
+
+
+def tuned(base: bytes, changes: dict, extra: bytes = b"") -> bytes:
+    target = bytearray(base)
+    for offset, data in changes.items():
+        target[offset:offset + len(data)] = data
+    return bytes(target) + extra
+
+
+def test_encode_decode_round_trip():
+    patches = [(0, b"abc"), (512, b"x" * 300)]
+    length, decoded = decode_delta(encode_delta(4096, patches))
+    assert length == 4096
+    assert [(offset, bytes(data)) for offset, data in decoded] == patches
+
+
+def test_decode_rejects_other_content():
+    with pytest.raises(ValueError):
+        decode_delta(b"not a delta at all")
+
+
+def test_compute_delta_only_keeps_changed_blocks():
+    base = os.urandom(20 * DELTA_BLOCK_BYTES)
+    target = tuned(base, {DELTA_BLOCK_BYTES * 3 + 10: b"\x00" * 20, DELTA_BLOCK_BYTES * 10: b"\xff"})
+    delta = asyncio.run(compute_delta(stored("base", base), stored("target", target), len(target)))
+    length, patches = decode_delta(delta)
+    assert length == len(target)
+    assert [(offset, len(data)) for offset, data in patches] == [
+        (DELTA_BLOCK_BYTES * 3, DELTA_BLOCK_BYTES),
+        (DELTA_BLOCK_BYTES * 10, DELTA_BLOCK_BYTES),
+    ]
+
+
+def test_compute_delta_merges_adjacent_blocks():
+    base = os.urandom(8 * DELTA_BLOCK_BYTES)
+    target = tuned(base, {DELTA_BLOCK_BYTES - 1: b"\x01\x02"})
+    delta = asyncio.run(compute_delta(stored("base", base), stored("target", target), len(target)))
+    _, patches = decode_delta(delta)
+    assert [(offset, len(data)) for offset, data in patches] == [(0, 2 * DELTA_BLOCK_BYTES)]
+
+
+def test_compute_delta_gives_up_past_the_budget():
+    base = os.urandom(8 * DELTA_BLOCK_BYTES)
+    target = os.urandom(len(base))
+    assert asyncio.run(compute_delta(stored("base", base), stored("target", target), 2 * DELTA_BLOCK_BYTES)) is None
+
+
+@pytest.mark.parametrize("target_length", [3000, 10000, 12345])
+def test_iter_patched_rebuilds_the_target(target_length):
+    base = os.urandom(10000)
+    target = tuned(base, {300: os.urandom(600), 4000: os.urandom(10)}, os.urandom(2345))[:target_length]
+    delta = asyncio.run(compute_delta(stored("base", base), stored("target", target), len(target)))
+    length, patches = decode_delta(delta)
+    rebuilt = collect(iter_patched(iter_chunks(base), length, patches))
+    assert rebuilt == target
+
+
+def test_iter_patched_yields_bytes():
+    length, patches = decode_delta(encode_delta(10, [(5, b"hello")]))
+    chunks = asyncio.run(_collect_chunks(iter_patched(iter_chunks(b"abc", 2), length, patches)))
+    assert all(type(chunk) is bytes for chunk in chunks)
+    assert b"".join(chunks) == b"abc" + b"hello"
+
+
+async def _collect_chunks(chunks) -> list:
+    return [chunk async for chunk in chunks]
+
+
+def test_iter_delta_content_reads_the_base_through_its_backend():
+    base = os.urandom(5000)
+    target = tuned(base, {1000: b"tuned map"})
+
+    class Backend:
+        async def open(self, file_id):
+            assert file_id == "delta-test-base"
+            return stored(file_id, base)
+
+    delta = asyncio.run(compute_delta(stored("base", base), stored("target", target), len(target)))
+    version = stored("delta-test-version", delta, {
+        "contentEncoding": "delta",
+        "deltaBase": "delta-test-base",
+        "originalLength": len(target),
+    })
+    version.backend = Backend()
+    assert collect(iter_delta_content(version)) == target
+    # Served from the rebuilt copy the second time
+    assert collect(version.iter_content()) == target
+    assert collect(version.iter_content(995, 1010)) == target[995:1011]
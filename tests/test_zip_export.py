@@ -0,0 +1,70 @@
+import io
+import os
+import zipfile
+import zlib
+from datetime import datetime
+
+from server import build_zip_layout
+
+
+def make_entries(contents: dict) -> list:
+    return [
+        {
+            "name": name,
+            "length": len(data),
+            "crc32": zlib.crc32(data),
+            "uploaded_at": datetime(2024, 3, 15, 10, 30, 12),
+            "data": data,
+        }
+        for name, data in contents.items()
+    ]
+
+
+def render(segments: list) -> bytes:
+    parts = []
+    for _, _, part in segments:
+        parts.append(part["data"] if isinstance(part, dict) else part)
+    return b"".join(parts)
+
+
+def test_layout_segments_are_contiguous():
+    segments, size = build_zip_layout(make_entries({"a.bin": b"x" * 100, "b.bin": b""}))
+    offset = 0
+    for segment_offset, length, part in segments:
+        assert segment_offset == offset
+        if not isinstance(part, dict):
+            assert length == len(part)
+        offset += length
+    assert offset == size
+
+
+def test_layout_is_a_readable_stored_zip():
+    contents = {
+        "original.bin": os.urandom(5000),
+        "tuned/stage1.bin": os.urandom(3000),
+        "empty.txt": b"",
+        "notes é.txt": "réglage".encode("utf-8"),
+    }
+    segments, size = build_zip_layout(make_entries(contents))
+    archive = render(segments)
+    assert len(archive) == size
+    with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == list(contents)
+        for info in zip_file.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED
+            assert info.date_time == (2024, 3, 15, 10, 30, 12)
+            assert zip_file.read(info) == contents[info.filename]
+
+
+def test_layout_only_depends_on_the_entries():
+    entries = make_entries({"a.bin": b"abc", "b.bin": b"defg"})
+    assert build_zip_layout(entries) == build_zip_layout(entries)
+
+
+def test_old_dates_are_clamped_to_the_dos_epoch():
+    entries = make_entries({"a.bin": b"abc"})
+    entries[0]["uploaded_at"] = datetime(1970, 1, 1)
+    segments, _ = build_zip_layout(entries)
+    with zipfile.ZipFile(io.BytesIO(render(segments))) as zip_file:
+        assert zip_file.infolist()[0].date_time == (1980, 1, 1, 0, 0, 0)